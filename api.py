@@ -20,11 +20,37 @@ Author: Paul Trippett (paul@pyhub.com)
 '''
 
 import httplib
+import Queue
+import atexit
 import base64
+import calendar
+import copy
+import cPickle
 import datetime
+import multiprocessing
+import os
+import random
+import re
+import select
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib
+import weakref
+import zlib
 import iso8601
+from email.utils import mktime_tz, parsedate_tz
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 from xml.dom import minidom
+from xml.parsers import expat
 
 
 try:
@@ -91,6 +117,1841 @@ class ChargifyServerError(ChargifyError):
     pass
 
 
+class ChargifyRateLimited(ChargifyError):
+    """
+    Returned when too many requests have been made and the API asks the
+    client to slow down.
+    @license    GNU General Public License
+    """
+    pass
+
+
+class ChargifyConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive HTTPS connections, keyed by host.
+    Connections are handed out with acquire() and given back with
+    release() once their response has been read in full.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, max_size=10, idle_timeout=30, timeout=None,
+        ssl_context=None, secure=True):
+        """
+        max_size is the number of idle connections kept per host,
+        idle_timeout the number of seconds an idle connection may be reused
+        for and timeout the socket timeout of new connections. Plain HTTP
+        is used when secure is False, e.g. against a local test server.
+        """
+        self.max_size = max_size
+        self.secure = secure
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        if ssl_context is None and hasattr(ssl, 'create_default_context'):
+            # One context for every connection, so the CA store is only
+            # loaded once and the TLS settings are shared.
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, host):
+        """
+        Open a new connection to the host
+        """
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if not self.secure:
+            return httplib.HTTPConnection(host, **kwargs)
+        if self.ssl_context is not None:
+            kwargs['context'] = self.ssl_context
+        return httplib.HTTPSConnection(host, **kwargs)
+
+    def _is_stale(self, conn):
+        """
+        An idle keep-alive socket should have nothing to read; if it is
+        readable the server has closed it (or sent garbage) and it can't be
+        reused.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def acquire(self, host):
+        """
+        Return a (connection, reused) tuple for the host, reusing an idle
+        connection when a fresh one is available.
+        """
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(host)
+            while idle:
+                candidate, released_at = idle.pop()
+                if now - released_at < self.idle_timeout and \
+                    not self._is_stale(candidate):
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return (conn, True)
+        return (self._connect(host), False)
+
+    def release(self, host, conn):
+        """
+        Give a connection back to the pool once its response has been read
+        """
+        if conn.sock is not None:
+            with self._lock:
+                idle = self._idle.setdefault(host, [])
+                if len(idle) < self.max_size:
+                    idle.append((conn, time.time()))
+                    return
+        conn.close()
+
+    def discard(self, conn):
+        """
+        Close a connection that must not be reused
+        """
+        conn.close()
+
+    def clear(self):
+        """
+        Close every idle connection in the pool
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, released_at in connections:
+                conn.close()
+
+
+class _BackgroundCall(threading.Thread):
+    """
+    Runs a function in a daemon thread; result() waits for it and returns
+    its value, re-raising anything it raised.
+    """
+
+    def __init__(self, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._function = function
+        self._args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._function(*self._args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+class _DeflateDecoder(object):
+    """
+    Decompresses a deflate response body incrementally. The spec says
+    zlib-wrapped, but some servers send raw deflate, which is told apart
+    by the first chunk failing as zlib.
+    """
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data):
+        if self._started:
+            return self._decoder.decompress(data)
+        self._started = True
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def flush(self):
+        return self._decoder.flush()
+
+
+def _decompressor(content_encoding):
+    """
+    Return an incremental decompressor (decompress() and flush()) for a
+    Content-Encoding, or None if the body isn't compressed
+    """
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return _DeflateDecoder()
+    return None
+
+
+class ChargifyTranscoder(object):
+    """
+    Does the work of ChargifyBase.fix_xml_encoding in a single pass, and
+    incrementally: feed() takes the response in chunks and returns the
+    transcoded output that is ready so far, close() returns the rest.
+    Joining the pieces gives exactly what fix_xml_encoding returns for the
+    whole body.
+    """
+    _ascii = ''.join([chr(i) for i in range(128)])
+
+    def __init__(self):
+        # Whether the unfinished line has had anything but whitespace yet,
+        # and the whitespace it ends in so far, held back in case the line
+        # ends there
+        self._started = False
+        self._blank = ''
+        self._pending = ''
+
+    @classmethod
+    def transcode(cls, xml):
+        """
+        Transcode a complete document
+        """
+        return cls._encode(''.join([i.strip() for i in xml.split('\n')]))
+
+    def feed(self, data):
+        """
+        Transcode the next chunk, returning what can be output so far.
+        Each chunk is only looked at once, so a document with few or no
+        line breaks comes out as it is fed too.
+        """
+        lines = data.split('\n')
+        last = lines.pop()
+        out = []
+        if lines:
+            # The unfinished line ends in this chunk
+            first = lines[0]
+            if not self._started:
+                first = first.lstrip()
+            first = first.rstrip()
+            if first:
+                out.append(self._blank + first)
+            out.extend([i.strip() for i in lines[1:]])
+            self._started = False
+            self._blank = ''
+        out.append(self._feed_line(last))
+        text = self._pending + ''.join(out)
+
+        # A multi-byte character can be split over the lines that get
+        # joined, so trailing non-ascii text waits for the next chunk.
+        if isinstance(text, unicode):
+            boundary = u'\x80'
+        else:
+            boundary = '\x80'
+        end = len(text)
+        while end and text[end - 1] >= boundary:
+            end -= 1
+        self._pending = text[end:]
+        return self._encode(text[:end])
+
+    def close(self):
+        """
+        Return whatever is left once the last chunk has been fed
+        """
+        text = self._pending
+        self._started = False
+        self._blank = self._pending = ''
+        return self._encode(text)
+
+    def _feed_line(self, line):
+        """
+        Return what can be output of the next piece of the unfinished
+        line: everything but leading whitespace and whitespace that may
+        turn out to be trailing
+        """
+        if not self._started:
+            line = line.lstrip()
+            if not line:
+                return ''
+            self._started = True
+        line = self._blank + line
+        text = line.rstrip()
+        self._blank = line[len(text):]
+        return text
+
+    @classmethod
+    def _encode(cls, text):
+        if isinstance(text, unicode):
+            try:
+                return text.encode('ascii')
+            except UnicodeEncodeError:
+                pass
+        elif not text.translate(None, cls._ascii):
+            return text
+        # Chargify encodes non-ascii characters in CP1252
+        return unicode(text).encode('CP1252', 'replace').decode('utf-8',
+            'ignore').encode('ascii', 'xmlcharrefreplace')
+
+
+class ChargifyXMLParser(object):
+    """
+    Builds model objects straight from expat events instead of going
+    through a DOM. The document is passed in with feed(), in as many chunks
+    as needed, and every node_name element is turned into an object as
+    soon as it closes; close() returns the objects that were built.
+    """
+
+    def __init__(self, base, obj_type, node_name, callback=None,
+        identity_map=None):
+        """
+        base is the object whose session the new objects get, callback
+        is called with each object instead of collecting them. Nested
+        objects are shared through identity_map if one is given.
+        """
+        self.objects = []
+        self._base = base
+        self._constructor = globals()[obj_type]
+        self._node_name = node_name
+        self._callback = callback or self.objects.append
+        self._identity_map = identity_map
+        # Open records as (object, field table, depth, node name); the
+        # field table is None once a record has been found in the
+        # identity map and the rest of its element is skipped.
+        self._records = []
+        self._depth = 0
+        self._field = None
+        self._field_type = None
+        self._text = []
+        self._in_cdata = False
+
+        self._parser = expat.ParserCreate()
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+        self._parser.StartCdataSectionHandler = self._start_cdata
+        self._parser.EndCdataSectionHandler = self._end_cdata
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the document
+        """
+        self._parser.Parse(data, False)
+
+    def close(self):
+        """
+        Finish the document and return the objects built from it
+        """
+        self._parser.Parse('', True)
+        return self.objects
+
+    def _new_record(self, constructor, name):
+        obj = self._base._new(constructor)
+        self._records.append((obj, constructor._get_field_table(),
+            self._depth, name))
+
+    def _start_element(self, name, attrs):
+        self._depth += 1
+        if not self._records:
+            if name == self._node_name:
+                self._new_record(self._constructor, name)
+            return
+
+        obj, field_table, depth, node_name = self._records[-1]
+        if self._depth == depth + 1 and field_table is not None:
+            if name in field_table:
+                self._new_record(field_table[name], name)
+            else:
+                self._field = name
+                self._field_type = attrs.get('type')
+                self._text = []
+
+    def _end_element(self, name):
+        depth = self._depth
+        self._depth -= 1
+        if not self._records:
+            return
+
+        obj, field_table, record_depth, node_name = self._records[-1]
+        if depth == record_depth:
+            self._records.pop()
+            if self._records:
+                if field_table is not None and \
+                    self._identity_map is not None:
+                    obj = self._identity_map.add(obj)
+                setattr(self._records[-1][0], node_name, obj)
+            else:
+                self._callback(obj)
+        elif depth == record_depth + 1 and self._field is not None:
+            value = ''.join(self._text)
+            if value and self._field_type == 'datetime':
+                value = datetime.datetime.fromtimestamp(iso8601.parse(value))
+            setattr(obj, self._field, value)
+            if self._field == 'id' and self._identity_map is not None and \
+                len(self._records) > 1:
+                # A nested object we already have; skip the rest of it
+                existing = self._identity_map.get(type(obj), value)
+                if existing is not None:
+                    self._records[-1] = (existing, None, record_depth,
+                        node_name)
+            self._field = None
+
+    def _character_data(self, data):
+        # Only the text directly inside a field counts, as with the DOM
+        if self._field is not None and not self._in_cdata and \
+            self._depth == self._records[-1][2] + 1:
+            self._text.append(data)
+
+    def _start_cdata(self):
+        self._in_cdata = True
+
+    def _end_cdata(self):
+        self._in_cdata = False
+
+
+def _json_records(data, node_name):
+    """
+    Return the fields of the node_name records in a decoded JSON document,
+    either a single {node_name: {...}} or a list of them
+    """
+    if isinstance(data, dict):
+        data = [data]
+    elif not isinstance(data, list):
+        return []
+    return [item[node_name] for item in data if isinstance(item, dict) and
+        isinstance(item.get(node_name), dict)]
+
+
+def _json_field(name, value):
+    """
+    Return a decoded JSON field value as the XML parser would have left it
+    """
+    if isinstance(value, unicode):
+        if value and name.endswith('_at'):
+            try:
+                return datetime.datetime.fromtimestamp(iso8601.parse(value))
+            except ValueError:
+                pass
+        return value
+    elif value is True:
+        return u'true'
+    elif value is False:
+        return u'false'
+    # null, or an object or list of no model type
+    return ''
+
+
+class ChargifyJSONParser(object):
+    """
+    Builds model objects from a JSON document, with the interface of
+    ChargifyXMLParser: feed() takes the document in chunks and close()
+    decodes it and returns the objects. Field values come out the way the
+    XML parser leaves them: numbers as their text, booleans as 'true' or
+    'false', null as '' and *_at timestamps as datetimes.
+    """
+
+    def __init__(self, base, obj_type, node_name, callback=None,
+        identity_map=None):
+        """
+        Arguments as for ChargifyXMLParser
+        """
+        self.objects = []
+        self._base = base
+        self._constructor = globals()[obj_type]
+        self._node_name = node_name
+        self._callback = callback or self.objects.append
+        self._identity_map = identity_map
+        self._chunks = []
+        # Timestamps repeat a lot within a response; each is decoded once
+        self._datetimes = {}
+
+    def feed(self, data):
+        """
+        Take the next chunk of the document
+        """
+        self._chunks.append(data)
+
+    def close(self):
+        """
+        Decode the document and return the objects built from it
+        """
+        data = json.loads(''.join(self._chunks), parse_int=unicode,
+            parse_float=unicode)
+        self._chunks = []
+        for fields in _json_records(data, self._node_name):
+            self._callback(self._build(self._constructor, fields, False))
+        return self.objects
+
+    def _build(self, constructor, fields, nested):
+        # Only nested objects are shared
+        identity_map = None
+        if nested:
+            identity_map = self._identity_map
+        if identity_map is not None and 'id' in fields:
+            existing = identity_map.get(constructor,
+                _json_field('id', fields['id']))
+            if existing is not None:
+                return existing
+
+        obj = self._base._new(constructor)
+        field_table = constructor._get_field_table()
+        datetimes = self._datetimes
+        for name, value in fields.iteritems():
+            if type(value) is unicode:
+                if value and name.endswith('_at'):
+                    try:
+                        value = datetimes[value]
+                    except KeyError:
+                        value = datetimes[value] = _json_field(name, value)
+            elif name in field_table and isinstance(value, dict):
+                value = self._build(field_table[name], value, True)
+            else:
+                value = _json_field(name, value)
+            setattr(obj, name, value)
+        if identity_map is not None:
+            obj = identity_map.add(obj)
+        return obj
+
+
+_type_rx = re.compile(r'\stype\s*=\s*["\']([^"\']*)["\']')
+_child_rx = re.compile(r'<([^\s/>!?]+)([^>]*)>')
+_entity_rx = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|[a-z]+);')
+_entities = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"',
+    'apos': u"'"}
+
+
+def _xml_entity(match):
+    name = match.group(1)
+    if name[:2] == '#x':
+        return unichr(int(name[2:], 16))
+    elif name[:1] == '#':
+        return unichr(int(name[1:]))
+    return _entities[name]
+
+
+def _xml_element_end(doc, name, pos, end):
+    """
+    Return where the content of the name element starting at pos ends and
+    where its closing tag ends, counting any name elements inside it
+    """
+    open_tag = '<' + name
+    close_tag = '</%s>' % name
+    depth = 1
+    while True:
+        close = doc.find(close_tag, pos, end)
+        if close < 0:
+            raise ValueError('unclosed <%s>' % name)
+        opened = doc.find(open_tag, pos, close)
+        while opened >= 0:
+            after = opened + len(open_tag)
+            if doc[after] in '> \t\r\n' and \
+                doc[doc.index('>', after) - 1] != '/':
+                depth += 1
+            opened = doc.find(open_tag, after, close)
+        depth -= 1
+        if not depth:
+            return (close, close + len(close_tag))
+        pos = close + len(close_tag)
+
+
+def _xml_direct_text(fragment):
+    """
+    Return the text directly inside an element whose content has child
+    elements, as ChargifyXMLParser sees it
+    """
+    text = []
+    depth = [0]
+    in_cdata = [False]
+
+    def start(name, attrs):
+        depth[0] += 1
+
+    def end(name):
+        depth[0] -= 1
+
+    def character_data(data):
+        if depth[0] == 1 and not in_cdata[0]:
+            text.append(data)
+
+    def start_cdata():
+        in_cdata[0] = True
+
+    def end_cdata():
+        in_cdata[0] = False
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = character_data
+    parser.StartCdataSectionHandler = start_cdata
+    parser.EndCdataSectionHandler = end_cdata
+    parser.Parse('<field>%s</field>' % fragment, True)
+    return ''.join(text)
+
+
+class _XMLRecord(object):
+    """
+    The undecoded fields of a lazy record: the element's content in the
+    transcoded document, indexed by field on first use
+    """
+    __slots__ = ('doc', 'start', 'end', 'identity_map', '_index')
+
+    def __init__(self, doc, start, end, identity_map):
+        self.doc = doc
+        self.start = start
+        self.end = end
+        self.identity_map = identity_map
+        self._index = None
+
+    def _get_index(self):
+        """
+        Map every child element onto (attributes, content start, content
+        end), without decoding anything
+        """
+        index = self._index
+        if index is not None:
+            return index
+        index = {}
+        doc = self.doc
+        pos = self.start
+        end = self.end
+        while True:
+            match = _child_rx.search(doc, pos, end)
+            if match is None:
+                break
+            name, attrs = match.groups()
+            if attrs.endswith('/'):
+                index[name] = (attrs, match.end(), match.end())
+                pos = match.end()
+            else:
+                content_end, pos = _xml_element_end(doc, name, match.end(),
+                    end)
+                index[name] = (attrs, match.end(), content_end)
+        self._index = index
+        return index
+
+    def names(self):
+        return self._get_index().keys()
+
+    def decode(self, obj, name):
+        """
+        Return the value of a field of obj, or raise KeyError
+        """
+        attrs, start, end = self._get_index()[name]
+        constructor = type(obj)._get_field_table().get(name)
+        if constructor is not None:
+            return _lazy_nested(obj, constructor,
+                _XMLRecord(self.doc, start, end, self.identity_map))
+
+        text = self.doc[start:end]
+        if not text:
+            return ''
+        if '<' in text:
+            value = _xml_direct_text(text)
+        elif '&' in text:
+            value = _entity_rx.sub(_xml_entity, text.decode('utf-8'))
+        else:
+            value = text.decode('utf-8')
+        if value and 'type' in attrs:
+            match = _type_rx.search(attrs)
+            if match is not None and match.group(1) == 'datetime':
+                value = datetime.datetime.fromtimestamp(iso8601.parse(value))
+        return value
+
+
+class _JSONRecord(object):
+    """
+    The undecoded fields of a lazy record: its decoded JSON object
+    """
+    __slots__ = ('fields', 'identity_map', 'datetimes')
+
+    def __init__(self, fields, identity_map, datetimes):
+        self.fields = fields
+        self.identity_map = identity_map
+        self.datetimes = datetimes
+
+    def names(self):
+        return self.fields.keys()
+
+    def decode(self, obj, name):
+        value = self.fields[name]
+        if type(value) is unicode:
+            if value and name.endswith('_at'):
+                try:
+                    return self.datetimes[value]
+                except KeyError:
+                    value = self.datetimes[value] = _json_field(name, value)
+            return value
+        constructor = type(obj)._get_field_table().get(name)
+        if constructor is not None and isinstance(value, dict):
+            return _lazy_nested(obj, constructor, _JSONRecord(value,
+                self.identity_map, self.datetimes))
+        return _json_field(name, value)
+
+
+def _lazy_nested(obj, constructor, raw):
+    """
+    Return the nested object of a lazy record, itself lazy, or the one
+    already in the identity map
+    """
+    nested = obj._new(constructor)
+    nested._raw = raw
+    identity_map = raw.identity_map
+    if identity_map is not None:
+        existing = identity_map.get(constructor, nested.id)
+        if existing is not None:
+            return existing
+        nested = identity_map.add(nested)
+    return nested
+
+
+class ChargifyLazyXMLParser(object):
+    """
+    Instead of decoding the node_name elements, only finds where each one
+    is in the document. The objects are lazy records: a field is decoded
+    the first time it's read (see ChargifyBase.__getattr__) and kept, so
+    reading a few fields of many records costs little more than those
+    fields. Nested objects are decoded the same way.
+    """
+
+    def __init__(self, base, obj_type, node_name, callback=None,
+        identity_map=None):
+        self.objects = []
+        self._base = base
+        self._constructor = globals()[obj_type]
+        self._node_name = node_name
+        self._callback = callback or self.objects.append
+        self._identity_map = identity_map
+        self._chunks = []
+        self._open_rx = re.compile(r'<%s(\s[^>]*|/)?>' %
+            re.escape(node_name))
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        doc = ''.join(self._chunks)
+        self._chunks = []
+        pos = 0
+        while True:
+            match = self._open_rx.search(doc, pos)
+            if match is None:
+                break
+            if doc[match.end() - 2] == '/':
+                start = end = pos = match.end()
+            else:
+                start = match.end()
+                end, pos = _xml_element_end(doc, self._node_name, start,
+                    len(doc))
+            obj = self._base._new(self._constructor)
+            obj._raw = _XMLRecord(doc, start, end, self._identity_map)
+            self._callback(obj)
+        return self.objects
+
+
+class ChargifyLazyJSONParser(ChargifyJSONParser):
+    """
+    Returns lazy records (see ChargifyLazyXMLParser) whose fields are
+    converted from the decoded JSON when first read
+    """
+
+    def close(self):
+        data = json.loads(''.join(self._chunks), parse_int=unicode,
+            parse_float=unicode)
+        self._chunks = []
+        for fields in _json_records(data, self._node_name):
+            obj = self._base._new(self._constructor)
+            obj._raw = _JSONRecord(fields, self._identity_map,
+                self._datetimes)
+            self._callback(obj)
+        return self.objects
+
+
+class _PassThrough(object):
+    """
+    The transcoder of formats that need no transcoding
+    """
+
+    def feed(self, data):
+        return data
+
+    def close(self):
+        return ''
+
+
+class ChargifyCodec(object):
+    """
+    A wire format: how requests are encoded and responses decoded. The
+    endpoints are spelled with .xml and url() swaps in the codec's
+    extension. Set one on a session (or pass codec to Chargify) to pick
+    the format of a client.
+    @license    GNU General Public License
+    """
+    extension = '.xml'
+    # Headers of GET's, and of requests with a body
+    get_headers = {}
+    request_headers = {}
+    parser_class = None
+    lazy_parser_class = None
+
+    def url(self, url):
+        """
+        Return the url of an endpoint in this format
+        """
+        path, sep, query = url.partition('?')
+        if path.endswith('.xml'):
+            path = path[:-4] + self.extension
+        return path + sep + query
+
+    def transcode(self, body):
+        """
+        Return a response body ready for the parser
+        """
+        return body
+
+    def transcoder(self):
+        """
+        Return an incremental transcode(), with the interface of
+        ChargifyTranscoder
+        """
+        return _PassThrough()
+
+    def parser(self, base, obj_type, node_name, callback=None,
+        identity_map=None, lazy=False):
+        """
+        Return a parser of responses into objects, see ChargifyXMLParser,
+        or into lazy records, see ChargifyLazyXMLParser
+        """
+        parser_class = lazy and self.lazy_parser_class or self.parser_class
+        return parser_class(base, obj_type, node_name, callback,
+            identity_map)
+
+    def dump(self, obj):
+        """
+        Return the request body of a model object
+        """
+        raise NotImplementedError
+
+    def dump_fields(self, node_name, fields):
+        """
+        Return the request body of a node_name record with the given
+        (name, value) fields; a list of (name, value) pairs as the value
+        makes a nested record
+        """
+        raise NotImplementedError
+
+    def load_usages(self, body):
+        """
+        Return the Usage objects of a transcoded usage response
+        """
+        raise NotImplementedError
+
+
+class ChargifyXMLCodec(ChargifyCodec):
+    """
+    The XML format: responses are transcoded (see ChargifyTranscoder) and
+    parsed by a ChargifyXMLParser.
+    @license    GNU General Public License
+    """
+    extension = '.xml'
+    get_headers = {'Content-Type': 'text/xml'}
+    request_headers = {
+        'Accept': 'application/xml',
+        'Content-Type': 'text/xml; charset="UTF-8"'
+    }
+    parser_class = ChargifyXMLParser
+    lazy_parser_class = ChargifyLazyXMLParser
+
+    def transcode(self, body):
+        return ChargifyTranscoder.transcode(body)
+
+    def transcoder(self):
+        return ChargifyTranscoder()
+
+    def dump(self, obj):
+        return obj._toxml()
+
+    def dump_fields(self, node_name, fields):
+        out = ['<?xml version="1.0" encoding="utf-8"?>']
+        self._write_fields(out, node_name, fields)
+        return ''.join(out)
+
+    def _write_fields(self, out, node_name, fields):
+        out.append('<%s>' % node_name)
+        for name, value in fields:
+            if isinstance(value, list):
+                self._write_fields(out, name, value)
+            else:
+                out.append('<%s>%s</%s>' % (name, _xml_text(value), name))
+        out.append('</%s>' % node_name)
+
+    def load_usages(self, body):
+        dom = minidom.parseString(body)
+        return [Usage(*tuple(chain.from_iterable([[x.data
+            for x in i.childNodes] or [None] for i in n.childNodes])))
+            for n in dom.getElementsByTagName('usage')]
+
+
+class ChargifyJSONCodec(ChargifyCodec):
+    """
+    The JSON format: the .json endpoints, decoded by a ChargifyJSONParser
+    into the same objects the XML format gives. Decoding JSON is a good
+    deal cheaper than parsing XML.
+    @license    GNU General Public License
+    """
+    extension = '.json'
+    get_headers = {'Accept': 'application/json'}
+    request_headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    parser_class = ChargifyJSONParser
+    lazy_parser_class = ChargifyLazyJSONParser
+
+    def dump(self, obj):
+        return json.dumps({obj.__xmlnodename__: obj._todict()}, default=str)
+
+    def dump_fields(self, node_name, fields):
+        return json.dumps({node_name: self._fields_dict(fields)},
+            default=str)
+
+    def _fields_dict(self, fields):
+        result = OrderedDict()
+        for name, value in fields:
+            if isinstance(value, list):
+                value = self._fields_dict(value)
+            result[name] = value
+        return result
+
+    def load_usages(self, body):
+        data = json.loads(body, parse_int=unicode, parse_float=unicode)
+        return [Usage(_json_field('id', fields.get('id')),
+            _json_field('memo', fields.get('memo')),
+            fields.get('quantity') or 0)
+            for fields in _json_records(data, 'usage')]
+
+
+class ChargifyProductCatalog(object):
+    """
+    An opt-in, in-process cache of the product catalog, indexed by id and
+    by handle. It is filled in one go from ChargifyProduct.getAll; a
+    product missing from a fresh catalog is fetched on its own. Products
+    expire ttl seconds after they were fetched and the least recently used
+    ones are evicted beyond max_size. The cached objects are shared by
+    every caller. With a ChargifyDiskCache the catalog is also kept on
+    disk, and a new process fills its catalog from there instead of the
+    API, refreshing it in the background if it has expired.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, ttl=300, max_size=1000, disk_cache=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.misses = 0
+        # id -> (product, expires_at), least recently used first
+        self._products = OrderedDict()
+        self._handles = {}
+        self._filled_until = 0
+        self._warmed = False
+        self._refresh = None
+        self._lock = threading.Lock()
+        # Held while the catalog is being filled on a miss
+        self._fill_lock = threading.Lock()
+
+    def get(self, index, key, load_all, load_one, load_stored=None):
+        """
+        Return the product whose id or handle (index) is key. On a miss the
+        catalog is filled with load_all() unless it is still fresh, and
+        load_one() fetches a product the catalog doesn't list. The first
+        miss fills it with load_stored() instead if that finds the catalog
+        on disk, see warm(). Concurrent misses wait for one fill instead
+        of each making their own.
+        """
+        key = str(key)
+        with self._lock:
+            product = self._lookup(index, key)
+            if product is not None:
+                self.hits += 1
+                return product
+            self.misses += 1
+            fresh = time.time() < self._filled_until
+
+        if not fresh:
+            with self._fill_lock:
+                # Filled by another miss while this one waited?
+                with self._lock:
+                    product = self._lookup(index, key)
+                    fresh = time.time() < self._filled_until
+                    warm = not self._warmed and load_stored is not None
+                    self._warmed = True
+                if product is None and not fresh:
+                    if warm:
+                        stored = load_stored()
+                        if stored is not None:
+                            self.warm(stored[0], stored[1], load_all)
+                            fresh = True
+                    if not fresh:
+                        load_all()
+                    with self._lock:
+                        product = self._lookup(index, key)
+        if product is None:
+            product = load_one()
+            if product is not None:
+                self.add([product])
+        return product
+
+    def fill(self, products):
+        """
+        Replace the catalog with a complete list of products
+        """
+        with self._lock:
+            self._products.clear()
+            self._handles.clear()
+            self._filled_until = time.time() + self.ttl
+        self.add(products)
+
+    def warm(self, products, expired, load_all):
+        """
+        Fill the catalog with products read from disk. Expired ones are
+        served all the same while load_all() fetches the catalog again
+        in the background.
+        """
+        self.fill(products)
+        if expired:
+            with self._lock:
+                if self._refresh is not None and self._refresh.is_alive():
+                    return
+                self._refresh = _BackgroundCall(load_all)
+
+    def add(self, products):
+        """
+        Add or refresh products in the catalog
+        """
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            for product in products:
+                self._remove(str(product.id))
+                self._products[str(product.id)] = (product, expires_at)
+                if product.handle:
+                    self._handles[str(product.handle)] = str(product.id)
+            while len(self._products) > self.max_size:
+                self._remove(self._products.iterkeys().next())
+
+    def invalidate(self, product=None):
+        """
+        Drop a product from the catalog, or the whole catalog if no
+        product is given
+        """
+        with self._lock:
+            if product is None:
+                self._products.clear()
+                self._handles.clear()
+                self._filled_until = 0
+            else:
+                self._remove(str(product.id))
+
+    def stats(self):
+        """
+        Return the hit and miss counters and the number of cached products
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._products)}
+
+    def _lookup(self, index, key):
+        if index == 'handle':
+            key = self._handles.get(key)
+        entry = self._products.pop(key, None)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            self._remove_handle(key, entry[0])
+            return None
+        # Move it to the most recently used end
+        self._products[key] = entry
+        return entry[0]
+
+    def _remove(self, key):
+        entry = self._products.pop(key, None)
+        if entry is not None:
+            self._remove_handle(key, entry[0])
+
+    def _remove_handle(self, key, product):
+        if self._handles.get(str(product.handle)) == key:
+            del self._handles[str(product.handle)]
+
+
+def _write_atomically(path, data):
+    """
+    Replace a file with data through a temporary file renamed into place,
+    so readers see either the old content or all of the new
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+        prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Bumped when the layout of ChargifyDiskCache files changes
+_DISK_CACHE_FORMAT = 1
+
+
+class ChargifyDiskCache(object):
+    """
+    Keeps responses (records of model objects, see _to_record, or
+    anything else picklable) in a directory, one file per key, for every
+    process on the host to share. Entries are pickled with the highest
+    protocol behind a header of the file format, version and time stored,
+    so an entry written by another version of the data reads as a miss.
+    Entries expire ttl seconds after they were stored but are handed out,
+    flagged expired, for up to max_age seconds. Files are written to a
+    temporary file and renamed into place, so readers never see half an
+    entry. Only point it at a directory no one else can write to: entries
+    are unpickled.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, directory, ttl=3600, max_age=7 * 24 * 3600, version=1):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        self.version = version
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0700)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+            urllib.quote(key, safe='') + '.pickle')
+
+    def get(self, key):
+        """
+        Return (value, expired) for the key, or None if there is no entry
+        of this version younger than max_age
+        """
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                header = cPickle.load(f)
+                if header[:2] != (_DISK_CACHE_FORMAT, self.version):
+                    return None
+                age = time.time() - header[2]
+                if age > self.max_age:
+                    return None
+                return (cPickle.load(f), age > self.ttl)
+            except Exception:
+                # Truncated, corrupt, or pickled classes that have gone
+                return None
+        finally:
+            f.close()
+
+    def put(self, key, value):
+        """
+        Store a value under the key, replacing any entry there
+        """
+        _write_atomically(self._path(key), cPickle.dumps((_DISK_CACHE_FORMAT,
+            self.version, time.time()), cPickle.HIGHEST_PROTOCOL) +
+            cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        """
+        Drop the entry of a key, if there is one
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class ChargifyIdentityMap(object):
+    """
+    Hands out one shared object per (model class, id) when nested products
+    and customers are mapped, so one embedded in thousands of
+    subscriptions is only built once. Set it on a session to share
+    objects across calls, or pass it to a single list call. Objects are
+    held weakly and drop out once nothing else refers to them.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, types=('ChargifyProduct', 'ChargifyCustomer')):
+        """
+        types names the model classes whose objects are shared
+        """
+        self.types = frozenset(types)
+        self._objects = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, cls, id):
+        """
+        Return the shared object of the class with the id, or None
+        """
+        if cls.__name__ not in self.types:
+            return None
+        with self._lock:
+            return self._objects.get((cls, id))
+
+    def add(self, obj):
+        """
+        Share an object, returning the one already shared under its id if
+        there is one
+        """
+        if type(obj).__name__ not in self.types or not obj.id:
+            return obj
+        with self._lock:
+            return self._objects.setdefault((type(obj), obj.id), obj)
+
+    def clear(self):
+        """
+        Forget every shared object
+        """
+        with self._lock:
+            self._objects.clear()
+
+    def __len__(self):
+        return len(self._objects)
+
+
+class ChargifyResponseCache(object):
+    """
+    Keeps the validators (ETag, Last-Modified) and the parsed objects of
+    GET responses. Cached urls are fetched with If-None-Match and
+    If-Modified-Since, and a 304 Not Modified hands back the objects from
+    last time without downloading or parsing anything. Only urls matching
+    one of the endpoints regular expressions are cached. sizeof gives the
+    size of an entry from its objects (1 per entry by default, len to
+    count objects); least recently used entries are evicted once the
+    total goes over max_size. The cached objects are shared by every
+    caller; lazy records are cached apart from fully decoded objects.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, endpoints, max_size=256, sizeof=None):
+        self.endpoints = [re.compile(endpoint) for endpoint in endpoints]
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda objects: 1)
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # (host, url, lazy) -> (etag, last modified, objects, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepts(self, url):
+        """
+        Whether responses of the url are cached
+        """
+        for endpoint in self.endpoints:
+            if endpoint.match(url):
+                return True
+        return False
+
+    def get_headers(self, host, url, lazy=False):
+        """
+        Return the conditional request headers for a cached url
+        """
+        with self._lock:
+            entry = self._entries.get((host, url, lazy))
+        headers = {}
+        if entry is not None:
+            if entry[0]:
+                headers['If-None-Match'] = entry[0]
+            if entry[1]:
+                headers['If-Modified-Since'] = entry[1]
+        return headers
+
+    def not_modified(self, host, url, lazy=False):
+        """
+        Return the cached objects of a url the server says hasn't changed,
+        or None if they are no longer cached; the full response fetched
+        instead is counted as a miss when it's stored
+        """
+        key = (host, url, lazy)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return list(entry[2])
+
+    def store(self, host, url, etag, last_modified, objects, lazy=False):
+        """
+        Cache the objects parsed from a response and its validators
+        """
+        key = (host, url, lazy)
+        with self._lock:
+            self.misses += 1
+            self._remove(key)
+            if not etag and not last_modified:
+                return
+            size = self.sizeof(objects)
+            self._entries[key] = (etag, last_modified, list(objects), size)
+            self.size += size
+            while self.size > self.max_size and self._entries:
+                self._remove(self._entries.iterkeys().next())
+
+    def clear(self):
+        """
+        Drop every cached response
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return the hit and miss counters and the size of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'size': self.size}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+
+class ChargifyRateLimiter(object):
+    """
+    A token bucket shared by every thread and model object of a session:
+    requests are let through at up to rate per second, with bursts of up
+    to burst. Failed requests are retried up to max_retries times after an
+    exponential backoff with full jitter, or after the server's
+    Retry-After; a 429 holds back every request of the session for that
+    long. Rate limited (429) requests are retried whatever their method,
+    server errors and broken connections only for idempotent methods.
+    @license    GNU General Public License
+    """
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE')
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(self, rate=None, burst=1, max_retries=3, backoff=0.5,
+        max_backoff=30):
+        """
+        rate is in requests per second, None for no limit; backoff is the
+        base delay in seconds, doubled on every retry up to max_backoff.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.requests = 0
+        self.throttled = 0
+        self.throttle_time = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self._tokens = float(burst)
+        self._updated_at = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until the next request may be sent
+        """
+        with self._lock:
+            now = time.time()
+            self.requests += 1
+            wait = max(0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                # Take the token now; a negative balance is the wait for it
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            if wait > 0:
+                self.throttled += 1
+                self.throttle_time += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def retry_delay(self, method, status, attempt, retry_after=None):
+        """
+        Return how long to wait before retrying a request that failed
+        with the status (None for a broken connection) on the attempt'th
+        try, or None if it must not be retried
+        """
+        if attempt >= self.max_retries:
+            return None
+        if status != 429 and (method not in self.idempotent_methods or
+            status not in self.retry_statuses + (None,)):
+            return None
+
+        delay = self._parse_retry_after(retry_after)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff,
+                self.backoff * 2 ** attempt))
+        with self._lock:
+            self.retries += 1
+            if status == 429:
+                self.rate_limited += 1
+                self._paused_until = max(self._paused_until,
+                    time.time() + delay)
+        return delay
+
+    def stats(self):
+        """
+        Return the request, throttling and retry counters
+        """
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled,
+                'throttle_time': self.throttle_time,
+                'retries': self.retries, 'rate_limited': self.rate_limited}
+
+    def _parse_retry_after(self, retry_after):
+        if not retry_after:
+            return None
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            date = parsedate_tz(retry_after)
+            if date is None:
+                return None
+            return max(0, mktime_tz(date) - time.time())
+
+
+_endpoint_id_rx = re.compile(r'/\d+(?=[/.])')
+_endpoint_handle_rx = re.compile(r'(/handle/)[^/]+(?=\.)')
+
+
+def _endpoint_template(url):
+    """
+    Return the endpoint of an url, with ids and handles replaced by
+    placeholders and the query string dropped
+    """
+    url = _endpoint_id_rx.sub('/{id}', url.split('?', 1)[0])
+    return _endpoint_handle_rx.sub(r'\1{handle}', url)
+
+
+class ChargifyMetrics(object):
+    """
+    An instrument that aggregates request events in memory: counts,
+    statuses, bytes and a histogram of each timing, per method and
+    endpoint. Pass it as the instrument of a session (or of the Chargify
+    entry point) and read it with report() or str().
+    @license    GNU General Public License
+    """
+    timings = ('total_time', 'connect_time', 'ttfb', 'transcode_time',
+        'parse_time')
+
+    # Upper bounds of the histogram buckets, in seconds
+    default_buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+        1, 2, 5, 10)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = '%s %s' % (event['method'], event['endpoint'])
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                endpoint = self._endpoints[key] = {'count': 0, 'errors': 0,
+                    'statuses': {}, 'bytes_in': 0, 'bytes_out': 0,
+                    'histograms': dict([(timing, [0] * (len(self.buckets) +
+                        1)) for timing in self.timings]),
+                    'totals': dict([(timing, 0.0) for timing in
+                        self.timings])}
+            endpoint['count'] += 1
+            if event['error'] is not None:
+                endpoint['errors'] += 1
+            status = event['status']
+            endpoint['statuses'][status] = \
+                endpoint['statuses'].get(status, 0) + 1
+            endpoint['bytes_in'] += event['bytes_in']
+            endpoint['bytes_out'] += event['bytes_out']
+            for timing in self.timings:
+                value = event[timing]
+                endpoint['totals'][timing] += value
+                endpoint['histograms'][timing][
+                    bisect_left(self.buckets, value)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def percentile(self, key, timing, p):
+        """
+        Estimate the p'th percentile of a timing of an endpoint ("GET
+        /subscriptions/{id}.xml") as the upper bound of the bucket it
+        falls in; None beyond the last bucket
+        """
+        with self._lock:
+            histogram = self._endpoints[key]['histograms'][timing]
+            rank = p / 100.0 * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.buckets + (None,), histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0
+
+    def report(self):
+        """
+        Return a copy of the counters and histograms, by endpoint
+        """
+        with self._lock:
+            report = {}
+            for key, endpoint in self._endpoints.items():
+                report[key] = dict(endpoint, statuses=dict(
+                    endpoint['statuses']), histograms=dict([(timing,
+                    list(histogram)) for timing, histogram in
+                    endpoint['histograms'].items()]),
+                    totals=dict(endpoint['totals']))
+            return report
+
+    def __str__(self):
+        lines = ['%-52s %6s %6s %9s %9s %9s %9s %9s' % ('endpoint', 'count',
+            'errors', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'parse ms')]
+        for key, endpoint in sorted(self.report().items()):
+            count = endpoint['count']
+            lines.append('%-52s %6d %6d %9.1f %9s %9s %9s %9.1f' % (key,
+                count, endpoint['errors'],
+                endpoint['totals']['total_time'] / count * 1000,
+                self._format_bound(self.percentile(key, 'total_time', 50)),
+                self._format_bound(self.percentile(key, 'total_time', 90)),
+                self._format_bound(self.percentile(key, 'total_time', 99)),
+                (endpoint['totals']['transcode_time'] +
+                    endpoint['totals']['parse_time']) / count * 1000))
+        return '\n'.join(lines)
+
+    def _format_bound(self, bound):
+        if bound is None:
+            return '>%g' % (self.buckets[-1] * 1000)
+        return '<=%g' % (bound * 1000)
+
+
+def _to_record(obj, records=None):
+    """
+    Return a compact, picklable record of a model object: its class name
+    and its (name, value) fields, nested objects as records of their own.
+    An object shared by several others gives the same record each time
+    through the records memo, so it is only pickled once.
+    """
+    if records is None:
+        records = {}
+    record = records.get(id(obj))
+    if record is None:
+        nested = obj.__attribute_types__
+        fields = []
+        for name, value in obj._get_fields():
+            if name in nested and isinstance(value, ChargifyBase):
+                value = _to_record(value, records)
+            fields.append((name, value))
+        record = records[id(obj)] = (type(obj).__name__, tuple(fields))
+    return record
+
+
+def _rehydrate(record, base, identity_map=None):
+    """
+    Build the model object of a record (see _to_record) in base's
+    session, sharing nested objects through the identity map if there is
+    one
+    """
+    name, fields = record
+    constructor = globals()[name]
+    nested = constructor.__attribute_types__
+    obj = base._new(constructor)
+    for name, value in fields:
+        if name in nested and isinstance(value, tuple):
+            value = _rehydrate(value, base, identity_map)
+            if identity_map is not None:
+                value = identity_map.add(value)
+        setattr(obj, name, value)
+    return obj
+
+
+def _parse_remote(codec, body, obj_type, node_name, shared_types):
+    """
+    Parse a response body in a worker process of a ChargifyParseExecutor
+    and return records of the objects (see _to_record). Nested objects of
+    shared_types are shared between them, like through an identity map,
+    unless shared_types is None.
+    """
+    base = ChargifyBase.__new__(ChargifyBase)
+    base.session = None
+    identity_map = None
+    if shared_types is not None:
+        identity_map = ChargifyIdentityMap(shared_types)
+    parser = codec.parser(base, obj_type, node_name,
+        identity_map=identity_map)
+    parser.feed(codec.transcode(body))
+    records = {}
+    return [_to_record(obj, records) for obj in parser.close()]
+
+
+class ChargifyParseExecutor(object):
+    """
+    Parses large response bodies in a pool of worker processes, so that
+    parsing runs on other cores while the threads of this one keep
+    fetching pages. Bodies of threshold bytes or more are sent to the pool
+    and the objects come back as plain records of their fields, to be
+    rebuilt in the calling session; smaller bodies, and lazy records, are
+    parsed in process. Set it as the parse_executor of a session (or of
+    the Chargify entry point). The worker processes are forked when it is
+    created, so create it before starting threads.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, processes=None, threshold=256 * 1024):
+        """
+        processes defaults to the number of cores
+        """
+        self.threshold = threshold
+        self._pool = multiprocessing.Pool(processes)
+
+    def accepts(self, body):
+        """
+        Whether the body is worth sending to the pool
+        """
+        return len(body) >= self.threshold
+
+    def parse(self, base, body, obj_type, node_name, identity_map=None):
+        """
+        Parse a body in the session's wire format in a worker process and
+        return the objects, in base's session. Blocks the calling thread,
+        but not the others, until they're back.
+        """
+        shared_types = None
+        if identity_map is not None:
+            shared_types = identity_map.types
+        records = self._pool.apply_async(_parse_remote, (base.session.codec,
+            body, obj_type, node_name, shared_types)).get()
+        return [_rehydrate(record, base, identity_map) for record in records]
+
+    def close(self):
+        """
+        Stop the worker processes once they're done
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+class ChargifySession(object):
+    """
+    The account model objects talk to: API key, sub domain, host,
+    connection pool and product catalog. Model objects keep a reference
+    to their session instead of copies of these, so a session is shared by
+    every object created from it or parsed from its responses.
+    @license    GNU General Public License
+    """
+    base_host = '.chargify.com'
+
+    # Shared by every session that isn't given a pool of its own
+    connection_pool = ChargifyConnectionPool()
+    product_catalog = None
+    identity_map = None
+    response_cache = None
+    rate_limiter = None
+    instrument = None
+    codec = ChargifyXMLCodec()
+    parse_executor = None
+    # The compressions responses may come in (None for uncompressed ones)
+    # and the size of the chunks response bodies are read in
+    accept_encoding = 'gzip, deflate'
+    read_size = 64 * 1024
+
+    # Default sessions by (api key, sub domain, host), see get()
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, apikey, subdomain, host=None, connection_pool=None,
+        product_catalog=None, identity_map=None, response_cache=None,
+        rate_limiter=None, instrument=None, codec=None, parse_executor=None):
+        """
+        host overrides the default <subdomain>.chargify.com; instrument is
+        called with an event dict after every request (see ChargifyMetrics);
+        codec is the wire format, XML unless given (see ChargifyCodec);
+        parse_executor parses large responses out of process (see
+        ChargifyParseExecutor)
+        """
+        self.api_key = apikey
+        self.sub_domain = subdomain
+        self.request_host = host or self.sub_domain + self.base_host
+        self.auth_string = base64.encodestring('%s:%s' % (apikey, 'x'))[:-1]
+        if connection_pool is not None:
+            self.connection_pool = connection_pool
+        if product_catalog is not None:
+            self.product_catalog = product_catalog
+        if identity_map is not None:
+            self.identity_map = identity_map
+        if response_cache is not None:
+            self.response_cache = response_cache
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
+        if instrument is not None:
+            self.instrument = instrument
+        if codec is not None:
+            self.codec = codec
+        if parse_executor is not None:
+            self.parse_executor = parse_executor
+
+    @classmethod
+    def get(cls, apikey, subdomain, host=None):
+        """
+        Return the default session of an account, creating it on first use
+        """
+        host = host or subdomain + cls.base_host
+        key = (apikey, subdomain, host)
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                session = cls._sessions[key] = cls(apikey, subdomain, host)
+            return session
+
+
+# Field tables of the model classes, see ChargifyBase._get_field_table
+_field_tables = {}
+
+# Slot descriptors of the model classes, see ChargifyBase._get_slots
+_slot_tables = {}
+
+# ChargifyBase subclass -> (slot fields, ignored names, nested object names)
+# for the serializer
+_xml_tables = {}
+
+
+def _timestamp(value):
+    """
+    Return a datetime as seconds since the epoch. Aware datetimes, like
+    the parsed ones, are converted through UTC; naive ones are taken as
+    local time.
+    """
+    if value.utcoffset() is None:
+        return time.mktime(value.timetuple())
+    return calendar.timegm(value.utctimetuple())
+
+
+def _xml_text(value):
+    """
+    Return a field value as escaped UTF-8 text content
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '"', '&quot;').replace('>', '&gt;')
+
+
+def _read_checkpoint(path, url, per_page):
+    """
+    Return the last page an export of url by per_page got through, or 0
+    to start from the beginning
+    """
+    if path is None or not os.path.exists(path):
+        return 0
+    f = open(path)
+    try:
+        state = json.load(f)
+    except ValueError:
+        return 0
+    finally:
+        f.close()
+    if state.get('url') != url or state.get('per_page') != per_page:
+        # The checkpoint of another export; start over
+        return 0
+    return state['page']
+
+
+def _write_checkpoint(path, url, per_page, page):
+    if path is not None:
+        _write_atomically(path, json.dumps({'url': url,
+            'per_page': per_page, 'page': page}))
+
+
+class _StreamLoad(object):
+    """
+    Parses a response body as it is read: each chunk goes through the
+    codec's incremental transcoder into the parser, so the body is never
+    held in one piece. close() returns the objects.
+    """
+
+    def __init__(self, base, obj_type, node_name, identity_map, lazy, event):
+        codec = base.session.codec
+        if identity_map is None:
+            identity_map = base.session.identity_map
+        self._transcoder = codec.transcoder()
+        self._parser = codec.parser(base, obj_type, node_name,
+            identity_map=identity_map, lazy=lazy)
+        self._event = event
+
+    def feed(self, data):
+        started_at = time.time()
+        data = self._transcoder.feed(data)
+        transcoded_at = time.time()
+        self._parser.feed(data)
+        self._timed(started_at, transcoded_at)
+
+    def close(self):
+        started_at = time.time()
+        data = self._transcoder.close()
+        transcoded_at = time.time()
+        self._parser.feed(data)
+        objs = self._parser.close()
+        self._timed(started_at, transcoded_at)
+        return objs
+
+    def _timed(self, started_at, transcoded_at):
+        if self._event is not None:
+            self._event['transcode_time'] += transcoded_at - started_at
+            self._event['parse_time'] += time.time() - transcoded_at
+
+
+class _BufferedLoad(object):
+    """
+    Collects a response body and parses it in one go once it has been
+    read, for sessions whose parse executor takes whole bodies
+    """
+
+    def __init__(self, base, obj_type, node_name, identity_map, lazy, event):
+        self._chunks = []
+        self._parse = partial(base._parse, obj_type=obj_type,
+            node_name=node_name, identity_map=identity_map, event=event,
+            lazy=lazy)
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        return self._parse(''.join(self._chunks))
+
+
 class ChargifyBase(object):
     """
     The ChargifyBase class provides a common base for all classes
@@ -99,208 +1960,740 @@ class ChargifyBase(object):
     """
     __ignore__ = ['api_key', 'sub_domain', 'base_host', 'request_host',
         'id', '__xmlnodename__']
+    # _raw holds the undecoded fields of a lazy record
+    __slots__ = ('session', '_raw', '__dict__', '__weakref__')
+    __defaults__ = {'id': None}
+    # Methods that don't talk to the API, see AsyncChargifyObject
+    __local__ = ('fix_xml_encoding',)
 
-    api_key = ''
-    sub_domain = ''
-    base_host = '.chargify.com'
-    request_host = ''
-    id = None
-
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey=None, subdomain=None, session=None):
         """
         Initialize the Class with the API Key and SubDomain for Requests
-        to the Chargify API
+        to the Chargify API, or with the ChargifySession to use
         """
-        self.api_key = apikey
-        self.sub_domain = subdomain
-        self.request_host = self.sub_domain + self.base_host
+        if session is None:
+            session = ChargifySession.get(apikey, subdomain)
+        self.session = session
 
-    def __get_xml_value(self, nodelist):
+    def __getattr__(self, name):
         """
-        Get the Text Value from an XML Node
+        Fields that haven't been set read as their class default. On a
+        lazy record they are decoded and kept the first time they're read.
         """
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-        return rc
+        if name[0] != '_':
+            try:
+                raw = self._raw
+            except AttributeError:
+                raw = None
+            if raw is not None:
+                try:
+                    value = raw.decode(self, name)
+                except KeyError:
+                    pass
+                else:
+                    setattr(self, name, value)
+                    return value
+        try:
+            return self.__defaults__[name]
+        except KeyError:
+            raise AttributeError(name)
 
-    def __get_object_from_node(self, node, obj_type=''):
+    def __getstate__(self):
         """
-        Copy values from a node into a new Object
+        Pickle the fields and the account, not the session: its pool and
+        locks can't be pickled
         """
-        if obj_type == '':
-            constructor = globals()[self.__name__]
-        else:
-            constructor = globals()[obj_type]
-        obj = constructor(self.api_key, self.sub_domain)
-
-        for childnodes in node.childNodes:
-            if childnodes.nodeType == 1 and not childnodes.nodeName == '':
-                if childnodes.nodeName in self.__attribute_types__:
-                    obj.__setattr__(childnodes.nodeName,
-                        self._applyS(childnodes.toxml(),
-                        self.__attribute_types__[childnodes.nodeName],
-                            childnodes.nodeName))
-                else:
-                    node_value = self.__get_xml_value(childnodes.childNodes)
-                    if "type" in  childnodes.attributes.keys():
-                        node_type = childnodes.attributes["type"]
-                        if node_value:
-                            if node_type.nodeValue == 'datetime':
-                                node_value = datetime.datetime.fromtimestamp(
-                                    iso8601.parse(node_value))
-                    obj.__setattr__(childnodes.nodeName, node_value)
+        session = self.session
+        return (dict(self._get_fields()), (session.api_key,
+            session.sub_domain, session.request_host))
+
+    def __setstate__(self, state):
+        """
+        Unpickle into the default session of the account, see
+        ChargifySession.get
+        """
+        fields, account = state
+        self.session = ChargifySession.get(*account)
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+
+    def __copy__(self):
+        """
+        Copies stay in the session of the original
+        """
+        obj = self._new(type(self))
+        for name, value in self._get_fields():
+            setattr(obj, name, value)
+        return obj
+
+    def __deepcopy__(self, memo):
+        """
+        Copies stay in the session of the original, nested objects are
+        copied too
+        """
+        obj = memo[id(self)] = self._new(type(self))
+        for name, value in self._get_fields():
+            setattr(obj, name, copy.deepcopy(value, memo))
+        return obj
+
+    @property
+    def api_key(self):
+        return self.session.api_key
+
+    @property
+    def sub_domain(self):
+        return self.session.sub_domain
+
+    @property
+    def request_host(self):
+        return self.session.request_host
+
+    @property
+    def connection_pool(self):
+        return self.session.connection_pool
+
+    def _new(self, constructor):
+        """
+        Create an object of the given model class in the same session
+        """
+        obj = constructor.__new__(constructor)
+        obj.session = self.session
         return obj
 
+    @classmethod
+    def _get_slots(cls):
+        """
+        Return (name, descriptor) for the field slots of the class,
+        worked out once per class and cached.
+        """
+        try:
+            return _slot_tables[cls]
+        except KeyError:
+            slots = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in ('session', '_raw', '__dict__',
+                        '__weakref__'):
+                        slots.append((name, klass.__dict__[name]))
+            _slot_tables[cls] = slots
+            return slots
+
+    def _materialize(self):
+        """
+        Decode the fields of a lazy record that haven't been read yet,
+        making it an ordinary object
+        """
+        try:
+            raw = self._raw
+        except AttributeError:
+            return
+        if raw is None:
+            return
+        self._raw = None
+        for name in raw.names():
+            try:
+                object.__getattribute__(self, name)
+            except AttributeError:
+                setattr(self, name, raw.decode(self, name))
+
+    def _get_fields(self):
+        """
+        Return (name, value) for every field that has been set, slots
+        first and then anything else set on the object
+        """
+        self._materialize()
+        fields = []
+        for name, descriptor in self._get_slots():
+            try:
+                fields.append((name, descriptor.__get__(self)))
+            except AttributeError:
+                pass
+        fields.extend(self.__dict__.iteritems())
+        return fields
+
+    @classmethod
+    def _get_field_table(cls):
+        """
+        Map the child nodes that hold nested objects onto their model
+        classes. Worked out once per class and cached.
+        """
+        try:
+            return _field_tables[cls]
+        except KeyError:
+            table = dict([(name, globals()[obj_type]) for name, obj_type in
+                cls.__attribute_types__.iteritems()])
+            _field_tables[cls] = table
+            return table
+
     def fix_xml_encoding(self, xml):
         """
         Chargify encodes non-ascii characters in CP1252.
         Decodes and re-encodes with xml characters.
         Strips out whitespace "text nodes".
         """
-        return unicode(''.join([i.strip() for i in xml.split('\n')])).encode(
-            'CP1252', 'replace').decode('utf-8', 'ignore').encode(
-            'ascii', 'xmlcharrefreplace')
+        return ChargifyTranscoder.transcode(xml)
+
+    def _parse(self, body, obj_type, node_name, identity_map=None,
+        event=None, lazy=False):
+        """
+        Parse a response body, in the session's wire format, into objects
+        of the given type, or lazy records of it, adding the time taken to
+        the request event if there is one. Large bodies go to the
+        session's parse executor if it has one.
+        """
+        if identity_map is None:
+            identity_map = self.session.identity_map
+        codec = self.session.codec
+        started_at = time.time()
+        executor = self.session.parse_executor
+        if executor is not None and not lazy and executor.accepts(body):
+            objs = executor.parse(self, body, obj_type, node_name,
+                identity_map)
+            if event is not None:
+                event['parse_time'] += time.time() - started_at
+            return objs
+        body = codec.transcode(body)
+        transcoded_at = time.time()
+        parser = codec.parser(self, obj_type, node_name,
+            identity_map=identity_map, lazy=lazy)
+        parser.feed(body)
+        objs = parser.close()
+        if event is not None:
+            event['transcode_time'] += transcoded_at - started_at
+            event['parse_time'] += time.time() - transcoded_at
+        return objs
 
-    def _applyS(self, xml, obj_type, node_name):
+    def _applyS(self, body, obj_type, node_name, event=None):
         """
-        Apply the values of the passed xml data to the a class
+        Apply the values of the passed data to the a class
         """
-        dom = minidom.parseString(self.fix_xml_encoding(xml))
-        nodes = dom.getElementsByTagName(node_name)
-        if nodes.length == 1:
-            return self.__get_object_from_node(nodes[0], obj_type)
+        objs = self._parse(body, obj_type, node_name, event=event)
+        if len(objs) == 1:
+            return objs[0]
 
-    def _applyA(self, xml, obj_type, node_name):
+    def _applyA(self, body, obj_type, node_name, identity_map=None,
+        event=None, lazy=False):
         """
         Apply the values of the passed data to a new class of the current type
         """
-        dom = minidom.parseString(self.fix_xml_encoding(xml))
-        nodes = dom.getElementsByTagName(node_name)
-        objs = []
-        for node in nodes:
-            objs.append(self.__get_object_from_node(node, obj_type))
+        return self._parse(body, obj_type, node_name, identity_map, event,
+            lazy)
+
+    def _getS(self, url, obj_type, node_name):
+        """
+        Fetch a url and return the single object in it
+        """
+        objs = self._getA(url, obj_type, node_name)
+        if len(objs) == 1:
+            return objs[0]
+
+    def _getA(self, url, obj_type, node_name, identity_map=None,
+        lazy=False):
+        """
+        Fetch a url and return the objects in it, as lazy records with
+        lazy. Urls the session's response cache accepts are fetched
+        conditionally, and the cached objects are returned as long as they
+        haven't changed.
+        """
+        return self._instrumented('GET', url, self._fetchA, url, obj_type,
+            node_name, identity_map, lazy)
+
+    def _fetchA(self, url, obj_type, node_name, identity_map, lazy, event):
+        # The body is parsed as it comes in, unless the parse executor
+        # wants it whole
+        if self.session.parse_executor is not None and not lazy:
+            load = _BufferedLoad
+        else:
+            load = _StreamLoad
+        load = partial(load, self, obj_type, node_name, identity_map, lazy,
+            event)
+
+        cache = self.session.response_cache
+        if cache is None or not cache.accepts(url):
+            return self._get_response(url, None, event, load)[1]
+
+        host = self.request_host
+        response, objs = self._get_response(url,
+            cache.get_headers(host, url, lazy), event, load)
+        if response.status == 304:
+            cached = cache.not_modified(host, url, lazy)
+            if cached is not None:
+                return cached
+            # Evicted in the meantime; fetch it in full
+            response, objs = self._get_response(url, None, event, load)
+        cache.store(host, url, response.getheader('etag'),
+            response.getheader('last-modified'), objs, lazy)
         return objs
 
-    def _toxml(self, dom):
+    def _iterA(self, url, obj_type, node_name, per_page=50, prefetch=False,
+        identity_map=None, lazy=False):
         """
-        Return a XML Representation of the object
+        Yield the objects of a paginated list one at a time, fetching one
+        page per request. With prefetch the next page is downloaded in the
+        background while the current one is being consumed.
         """
-        element = minidom.Element(self.__xmlnodename__)
-        for property, value in self.__dict__.iteritems():
-            if not property in self.__ignore__:
-                if property in self.__attribute_types__:
-                    element.appendChild(value._toxml(dom))
+        def fetch(page):
+            return self._getA(self._page_url(url, page, per_page), obj_type,
+                node_name, identity_map, lazy)
+
+        page = 1
+        next_page = partial(fetch, page)
+        while next_page is not None:
+            objs = next_page()
+            next_page = None
+            # A short page is the last one
+            if len(objs) >= per_page:
+                page += 1
+                if prefetch:
+                    next_page = _BackgroundCall(fetch, page).result
                 else:
-                    node = minidom.Element(property)
-                    node_txt = dom.createTextNode(str(value))
-                    node.appendChild(node_txt)
-                    element.appendChild(node)
-        return element
+                    next_page = partial(fetch, page)
+            for obj in objs:
+                yield obj
 
-    def _get(self, url):
+    def _page_url(self, url, page, per_page):
+        separator = '?' in url and '&' or '?'
+        return '%s%spage=%d&per_page=%d' % (url, separator, page, per_page)
+
+    def _exportA(self, url, obj_type, node_name, per_page=200, window=4,
+        ordered=True, checkpoint=None, identity_map=None, lazy=False):
         """
-        Handle HTTP GET's to the API
+        Yield every object of a paginated list, fetching up to window
+        pages at once; the first page shorter than per_page is the last
+        one. The objects come in page order, or with ordered=False page by
+        page as the pages arrive. With checkpoint, the path of a file,
+        the last page up to which every page has been yielded is kept
+        there, and an export of the same url and page size that was
+        interrupted starts again after it; with ordered=False, pages past
+        that one that had already been yielded are yielded again. The file
+        is removed once the export is complete. A page that fails fails
+        the export once every page before it has been yielded, unless it
+        turns out to be past the last page.
         """
-        headers = {
-            "Authorization": "Basic %s" % self._get_auth_string(),
-            "User-Agent": "pyChargify",
-            "Content-Type": 'text/xml'
-        }
+        done = _read_checkpoint(checkpoint, url, per_page)
+        results = Queue.Queue()
+        workers = ThreadPool(window)
+
+        def fetch(page):
+            try:
+                results.put((page, self._getA(self._page_url(url, page,
+                    per_page), obj_type, node_name, identity_map, lazy), None))
+            except Exception:
+                results.put((page, None, sys.exc_info()))
+
+        next_page = done + 1
+        last_page = None
+        in_flight = 0
+        # page -> (objects, error) of the pages past done that have
+        # arrived; the objects are None once they have been yielded (as
+        # they arrive)
+        pending = {}
+        try:
+            while True:
+                while last_page is None or next_page <= last_page:
+                    # In order, pages waiting for an earlier one count
+                    # against the window too, so they can't pile up behind
+                    # a slow page
+                    if ordered:
+                        outstanding = next_page - done - 1
+                    else:
+                        outstanding = in_flight
+                    if outstanding >= window:
+                        break
+                    workers.apply_async(fetch, (next_page,))
+                    next_page += 1
+                    in_flight += 1
+                if not in_flight:
+                    break
+                page, objs, error = results.get()
+                in_flight -= 1
+                if error is None and len(objs) < per_page and \
+                    (last_page is None or page < last_page):
+                    last_page = page
+                if last_page is not None and page > last_page:
+                    continue
+
+                if error is None and not ordered:
+                    for obj in objs:
+                        yield obj
+                    objs = None
+                pending[page] = (objs, error)
+                # A failed page only counts once it's the next one, as it
+                # may yet turn out to be past the last page
+                while done + 1 in pending and \
+                    (last_page is None or done + 1 <= last_page):
+                    objs, error = pending.pop(done + 1)
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    if objs:
+                        for obj in objs:
+                            yield obj
+                    done += 1
+                    _write_checkpoint(checkpoint, url, per_page, done)
+        finally:
+            # Fetches still in flight finish on their own
+            workers.close()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def _since_url(self, url, since):
+        """
+        Add a filter to a list url for the objects updated at or after the
+        datetime since, if there is one
+        """
+        if since is None:
+            return url
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+            time.gmtime(_timestamp(since)))
+        return '%s?date_field=updated_at&start_datetime=%s' % (url,
+            urllib.quote(since))
+
+    @classmethod
+    def _get_xml_table(cls):
+        """
+        Return the slot fields to serialize, the names never to serialize
+        and the names holding nested objects. Worked out once per class
+        and cached.
+        """
+        try:
+            return _xml_tables[cls]
+        except KeyError:
+            ignored = frozenset(cls.__ignore__)
+            table = ([(name, descriptor) for name, descriptor in
+                cls._get_slots() if name not in ignored], ignored,
+                frozenset(cls.__attribute_types__))
+            _xml_tables[cls] = table
+            return table
+
+    def _todict(self):
+        """
+        Return the fields to serialize as a dict, with nested objects as
+        dicts under their node name
+        """
+        self._materialize()
+        slots, ignored, nested = self._get_xml_table()
+        fields = {}
+        for name, descriptor in slots:
+            try:
+                value = descriptor.__get__(self)
+            except AttributeError:
+                continue
+            if name in nested:
+                fields[value.__xmlnodename__] = value._todict()
+            else:
+                fields[name] = value
+        for name, value in self.__dict__.iteritems():
+            if name in ignored:
+                continue
+            if name in nested:
+                fields[value.__xmlnodename__] = value._todict()
+            else:
+                fields[name] = value
+        return fields
+
+    def _toxml(self):
+        """
+        Return a XML Representation of the object, as a UTF-8 document
+        """
+        out = ['<?xml version="1.0" encoding="utf-8"?>']
+        self._write_xml(out)
+        return ''.join(out)
 
-        r = httplib.HTTPSConnection(self.request_host)
-        r.request('GET', url, None, headers)
-        response = r.getresponse()
+    def _write_xml(self, out):
+        """
+        Append the element of the object to the list of strings out
+        """
+        self._materialize()
+        slots, ignored, nested = self._get_xml_table()
+        node_name = self.__xmlnodename__
+        start = len(out)
+        out.append(None)
+        for name, descriptor in slots:
+            try:
+                value = descriptor.__get__(self)
+            except AttributeError:
+                continue
+            if name in nested:
+                value._write_xml(out)
+            else:
+                out.append('<%s>%s</%s>' % (name, _xml_text(value), name))
+        for name, value in self.__dict__.iteritems():
+            if name in ignored:
+                continue
+            if name in nested:
+                value._write_xml(out)
+            else:
+                out.append('<%s>%s</%s>' % (name, _xml_text(value), name))
+        if len(out) == start + 1:
+            out[start] = '<%s/>' % node_name
+        else:
+            out[start] = '<%s>' % node_name
+            out.append('</%s>' % node_name)
 
+    def _check_status(self, status):
+        """
+        Raise the matching ChargifyError for an error status
+        """
         # Unauthorized Error
-        if response.status == 401:
+        if status == 401:
             raise ChargifyUnAuthorized()
 
         # Forbidden Error
-        elif response.status == 403:
+        elif status == 403:
             raise ChargifyForbidden()
 
         # Not Found Error
-        elif response.status == 404:
+        elif status == 404:
             raise ChargifyNotFound()
 
         # Unprocessable Entity Error
-        elif response.status == 422:
+        elif status == 422:
             raise ChargifyUnProcessableEntity()
 
+        # Rate Limit Error
+        elif status == 429:
+            raise ChargifyRateLimited()
+
         # Generic Server Errors
-        elif response.status in [405, 500]:
+        elif status in [405, 500, 502, 503, 504]:
             raise ChargifyServerError()
 
-        return response.read()
+    def _start_event(self, method, url):
+        """
+        Return a new request event, or None if the session has no
+        instrument to hand it to
+        """
+        if self.session.instrument is None:
+            return None
+        return {'method': method,
+            'endpoint': _endpoint_template(self.session.codec.url(url)),
+            'url': url, 'status': None, 'error': None, 'attempts': 0,
+            'started_at': time.time(), 'connect_time': 0.0, 'ttfb': 0.0,
+            'total_time': 0.0, 'bytes_out': 0, 'bytes_in': 0,
+            'transcode_time': 0.0, 'parse_time': 0.0}
+
+    def _finish_event(self, event, error=None):
+        if event is None:
+            return
+        event['total_time'] = time.time() - event['started_at']
+        if error is not None:
+            event['error'] = error.__class__.__name__
+        self.session.instrument(event)
+
+    def _instrumented(self, method, url, call, *args):
+        """
+        Return call(*args, event), handing the session's instrument an
+        event that describes the request made, once it's done
+        """
+        event = self._start_event(method, url)
+        try:
+            result = call(*args + (event,))
+        except Exception, e:
+            self._finish_event(event, e)
+            raise
+        self._finish_event(event)
+        return result
+
+    def _send(self, method, url, data, headers, event=None, load=None):
+        """
+        Send a request and return the response and its body, or what
+        load made of it (see _send_once). With a rate limiter on the
+        session the request waits for its turn and failed attempts are
+        retried as the limiter allows.
+        """
+        limiter = self.session.rate_limiter
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                response, body = self._send_once(method, url, data, headers,
+                    event, load)
+            except (httplib.HTTPException, socket.error):
+                if limiter is None:
+                    raise
+                delay = limiter.retry_delay(method, None, attempt)
+                if delay is None:
+                    raise
+            else:
+                if limiter is None or \
+                    response.status not in limiter.retry_statuses:
+                    return (response, body)
+                delay = limiter.retry_delay(method, response.status, attempt,
+                    response.getheader('retry-after'))
+                if delay is None:
+                    return (response, body)
+            attempt += 1
+            time.sleep(delay)
+
+    def _send_once(self, method, url, data, headers, event=None,
+        load=None):
+        """
+        Send a request over a pooled connection and return the response
+        and its body. A reused connection that turns out to be dead is
+        retried once on a new connection, except for POST's. With load,
+        the body of a 200 response is fed to a new load() as it is read
+        and what its close() returns comes back instead of the body.
+        """
+        pool = self.connection_pool
+        while True:
+            conn, reused = pool.acquire(self.request_host)
+            try:
+                started_at = time.time()
+                if not reused:
+                    conn.connect()
+                connected_at = time.time()
+                conn.request(method, url, data, headers)
+                response = conn.getresponse()
+                first_byte_at = time.time()
+                body, received = self._read_body(response, load)
+            except (httplib.HTTPException, socket.error):
+                pool.discard(conn)
+                if reused and method != 'POST':
+                    continue
+                raise
+            except Exception:
+                # The rest of the response is still on the connection
+                pool.discard(conn)
+                raise
+            if event is not None:
+                event['attempts'] += 1
+                event['status'] = response.status
+                event['connect_time'] += connected_at - started_at
+                event['ttfb'] = first_byte_at - connected_at
+                event['bytes_out'] += len(data or '')
+                event['bytes_in'] += received
+            if response.will_close:
+                pool.discard(conn)
+            else:
+                pool.release(self.request_host, conn)
+            return (response, body)
+
+    def _read_body(self, response, load=None):
+        """
+        Read a response body in chunks, decompressing it as it comes if
+        the server compressed it. Return the body, or what load made of
+        it (see _send_once), and the number of bytes received.
+        """
+        decoder = _decompressor(response.getheader('content-encoding'))
+        consumer = None
+        if load is not None and response.status == 200:
+            consumer = load()
+        read_size = self.session.read_size
+        chunks = []
+        received = 0
+        while True:
+            chunk = response.read(read_size)
+            if not chunk:
+                break
+            received += len(chunk)
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            if consumer is not None:
+                consumer.feed(chunk)
+            else:
+                chunks.append(chunk)
+        if decoder is not None:
+            chunk = decoder.flush()
+            if consumer is not None:
+                consumer.feed(chunk)
+            else:
+                chunks.append(chunk)
+        if consumer is not None:
+            return (consumer.close(), received)
+        return (''.join(chunks), received)
+
+    def _get(self, url):
+        """
+        Handle HTTP GET's to the API
+        """
+        response, body = self._instrumented('GET', url, self._get_response,
+            url, None)
+        return body
+
+    def _get_response(self, url, extra_headers=None, event=None, load=None):
+        """
+        Send a GET, with any extra headers, and return the response and
+        its body, or what load made of it (see _send_once)
+        """
+        codec = self.session.codec
+        headers = {
+            "Authorization": "Basic %s" % self._get_auth_string(),
+            "User-Agent": "pyChargify"
+        }
+        headers.update(codec.get_headers)
+        if self.session.accept_encoding:
+            headers['Accept-Encoding'] = self.session.accept_encoding
+        if extra_headers:
+            headers.update(extra_headers)
+
+        response, body = self._send('GET', codec.url(url), None, headers,
+            event, load)
+        self._check_status(response.status)
+        return (response, body)
 
     def _post(self, url, data):
         """
         Handle HTTP POST's to the API
         """
-        return self._request('POST', url, data)
+        return self._instrumented('POST', url, self._request, 'POST', url,
+            data)
 
     def _put(self, url, data):
         """
         Handle HTTP PUT's to the API
         """
-        return self._request('PUT', url, data)
+        return self._instrumented('PUT', url, self._request, 'PUT', url,
+            data)
 
     def _delete(self, url, data):
         """
         Handle HTTP DELETE's to the API
         """
-        return self._request('DELETE', url, data)
+        return self._instrumented('DELETE', url, self._request, 'DELETE',
+            url, data)
 
-    def _request(self, method, url, data=''):
+    def _request(self, method, url, data='', event=None):
         """
         Handled the request and sends it to the server
         """
-        http = httplib.HTTPSConnection(self.request_host)
-
-        http.putrequest(method, url)
-        http.putheader("Authorization", "Basic %s" % self._get_auth_string())
-        http.putheader("User-Agent", "pychargify")
-        http.putheader("Host", self.request_host)
-        http.putheader("Accept", "application/xml")
-        http.putheader("Content-Length", str(len(data)))
-        http.putheader("Content-Type", 'text/xml; charset="UTF-8"')
-        http.endheaders()
-
-        print('sending: %s' % data)
-
-        http.send(data)
-        response = http.getresponse()
-
-        # Unauthorized Error
-        if response.status == 401:
-            raise ChargifyUnAuthorized()
-
-        # Forbidden Error
-        elif response.status == 403:
-            raise ChargifyForbidden()
-
-        # Not Found Error
-        elif response.status == 404:
-            raise ChargifyNotFound()
+        codec = self.session.codec
+        headers = {
+            "Authorization": "Basic %s" % self._get_auth_string(),
+            "User-Agent": "pychargify",
+            "Host": self.request_host,
+            "Content-Length": str(len(data))
+        }
+        headers.update(codec.request_headers)
+        if self.session.accept_encoding:
+            headers['Accept-Encoding'] = self.session.accept_encoding
 
-        # Unprocessable Entity Error
-        elif response.status == 422:
-            raise ChargifyUnProcessableEntity()
+        response, body = self._send(method, codec.url(url), data, headers,
+            event)
+        self._check_status(response.status)
+        return body
 
-        # Generic Server Errors
-        elif response.status in [405, 500]:
-            raise ChargifyServerError()
+    def _requestS(self, method, url, data, obj_type, node_name):
+        """
+        Send a request and return the single object in its response
+        """
+        objs = self._instrumented(method, url, self._requestA, method, url,
+            data, obj_type, node_name)
+        if len(objs) == 1:
+            return objs[0]
 
-        return response.read()
+    def _requestA(self, method, url, data, obj_type, node_name, event=None):
+        """
+        Send a request and return the objects in its response
+        """
+        return self._parse(self._request(method, url, data, event),
+            obj_type, node_name, event=event)
 
     def _save(self, url, node_name):
         """
         Save the object using the passed URL as the API end point
         """
-        dom = minidom.Document()
-        dom.appendChild(self._toxml(dom))
+        data = self.session.codec.dump(self)
 
         request_made = {
             'day': datetime.datetime.today().day,
@@ -309,8 +2702,8 @@ class ChargifyBase(object):
         }
 
         if self.id:
-            obj = self._applyS(self._put('/' + url + '/' + self.id + '.xml',
-                dom.toxml(encoding="utf-8")), self.__name__, node_name)
+            obj = self._requestS('PUT', '/' + url + '/' + self.id + '.xml',
+                data, self.__name__, node_name)
             if obj:
                 if type(obj.updated_at) == datetime.datetime:
                     if (obj.updated_at.day == request_made['day']) and \
@@ -320,8 +2713,8 @@ class ChargifyBase(object):
                         return (True, obj)
             return (False, obj)
         else:
-            obj = self._applyS(self._post('/' + url + '.xml',
-                dom.toxml(encoding="utf-8")), self.__name__, node_name)
+            obj = self._requestS('POST', '/' + url + '.xml', data,
+                self.__name__, node_name)
             if obj:
                 if type(obj.updated_at) == datetime.datetime:
                     if (obj.updated_at.day == request_made['day']) and \
@@ -331,7 +2724,7 @@ class ChargifyBase(object):
             return (False, obj)
 
     def _get_auth_string(self):
-        return base64.encodestring('%s:%s' % (self.api_key, 'x'))[:-1]
+        return self.session.auth_string
 
 
 class ChargifyCustomer(ChargifyBase):
@@ -342,36 +2735,57 @@ class ChargifyCustomer(ChargifyBase):
     __name__ = 'ChargifyCustomer'
     __attribute_types__ = {}
     __xmlnodename__ = 'customer'
+    __slots__ = ('id', 'first_name', 'last_name', 'email', 'cc_emails',
+        'organization', 'reference', 'created_at', 'updated_at',
+        'modified_at', 'address', 'address_2', 'city', 'state', 'zip',
+        'country', 'phone', 'verified', 'portal_customer_created_at',
+        'portal_invite_last_sent_at', 'portal_invite_last_accepted_at',
+        'tax_exempt', 'vat_number', 'parent_id', 'locale')
+    __defaults__ = {
+        'id': None,
+        'first_name': '',
+        'last_name': '',
+        'email': '',
+        'organization': '',
+        'reference': '',
+        'created_at': None,
+        'modified_at': None
+    }
 
-    id = None
-    first_name = ''
-    last_name = ''
-    email = ''
-    organization = ''
-    reference = ''
-    created_at = None
-    modified_at = None
-
-    def __init__(self, apikey, subdomain, nodename=''):
-        super(ChargifyCustomer, self).__init__(apikey, subdomain)
+    def __init__(self, apikey=None, subdomain=None, nodename='',
+        session=None):
+        super(ChargifyCustomer, self).__init__(apikey, subdomain, session)
         if nodename:
             self.__xmlnodename__ = nodename
 
-    def getAll(self):
-        return self._applyA(self._get('/customers.xml'),
-            self.__name__, 'customer')
+    def getAll(self, lazy=False):
+        return list(self.iterAll(lazy=lazy))
+
+    def iterAll(self, per_page=50, prefetch=False, since=None, lazy=False):
+        return self._iterA(self._since_url('/customers.xml', since),
+            self.__name__, 'customer', per_page, prefetch, lazy=lazy)
+
+    def exportAll(self, per_page=200, window=4, ordered=True,
+        checkpoint=None, since=None, lazy=False):
+        """
+        Yield every customer, fetching window pages at a time, resuming
+        from the checkpoint file if one is given, see ChargifyBase._exportA
+        """
+        return self._exportA(self._since_url('/customers.xml', since),
+            self.__name__, 'customer', per_page, window, ordered, checkpoint,
+            lazy=lazy)
 
     def getById(self, id):
-        return self._applyS(self._get('/customers/' + str(id) + '.xml'),
+        return self._getS('/customers/' + str(id) + '.xml',
             self.__name__, 'customer')
 
     def getByReference(self, reference):
-        return self._applyS(self._get('/customers/lookup.xml?reference=' +
-            str(reference)), self.__name__, 'customer')
+        return self._getS('/customers/lookup.xml?reference=' +
+            str(reference), self.__name__, 'customer')
 
-    def getSubscriptions(self):
-        obj = ChargifySubscription(self.api_key, self.sub_domain)
-        return obj.getByCustomerId(self.id)
+    def getSubscriptions(self, identity_map=None):
+        obj = self._new(ChargifySubscription)
+        return obj.getByCustomerId(self.id, identity_map)
 
     def save(self):
         return self._save('customers', 'customer')
@@ -385,35 +2799,97 @@ class ChargifyProduct(ChargifyBase):
     __name__ = 'ChargifyProduct'
     __attribute_types__ = {}
     __xmlnodename__ = 'product'
+    __slots__ = ('id', 'name', 'handle', 'description', 'accounting_code',
+        'price_in_cents', 'interval', 'interval_unit',
+        'initial_charge_in_cents', 'trial_price_in_cents', 'trial_interval',
+        'trial_interval_unit', 'expiration_interval',
+        'expiration_interval_unit', 'initial_charge_after_trial',
+        'request_credit_card', 'require_credit_card',
+        'request_billing_address', 'require_billing_address',
+        'require_shipping_address', 'return_url', 'return_params',
+        'update_return_url', 'update_return_params', 'taxable', 'tax_code',
+        'version_number', 'product_family', 'public_signup_pages',
+        'archived_at', 'created_at', 'updated_at')
+    __local__ = ChargifyBase.__local__ + ('getPaymentPageUrl',
+        'getPriceInDollars', 'getFormattedPrice')
+    __defaults__ = {
+        'id': None,
+        'price_in_cents': 0,
+        'name': '',
+        'handle': '',
+        'product_family': {},
+        'accounting_code': '',
+        'interval_unit': '',
+        'interval': 0
+    }
 
-    id = None
-    price_in_cents = 0
-    name = ''
-    handle = ''
-    product_family = {}
-    accounting_code = ''
-    interval_unit = ''
-    interval = 0
-
-    def __init__(self, apikey, subdomain, nodename=''):
-        super(ChargifyProduct, self).__init__(apikey, subdomain)
+    def __init__(self, apikey=None, subdomain=None, nodename='',
+        session=None):
+        super(ChargifyProduct, self).__init__(apikey, subdomain, session)
         if nodename:
             self.__xmlnodename__ = nodename
 
+    @property
+    def catalog(self):
+        """
+        The ChargifyProductCatalog that getById and getByHandle answer from
+        """
+        return self.session.product_catalog
+
     def getAll(self):
-        return self._applyA(self._get('/products.xml'),
-            self.__name__, 'product')
+        products = self._getA('/products.xml', self.__name__, 'product')
+        if self.catalog is not None:
+            self.catalog.fill(products)
+            if self.catalog.disk_cache is not None:
+                records = {}
+                self.catalog.disk_cache.put(self._stored_key(),
+                    [_to_record(product, records) for product in products])
+        return products
 
     def getById(self, id):
-        return self._applyS(self._get('/products/' + str(id) + '.xml'),
-            self.__name__, 'product')
+        if self.catalog is not None:
+            return self.catalog.get('id', id, self.getAll,
+                partial(self._getById, id), self._loadStored)
+        return self._getById(id)
 
     def getByHandle(self, handle):
-        return self._applyS(self._get('/products/handle/' + str(handle) +
-            '.xml'), self.__name__, 'product')
+        if self.catalog is not None:
+            return self.catalog.get('handle', handle, self.getAll,
+                partial(self._getByHandle, handle), self._loadStored)
+        return self._getByHandle(handle)
+
+    def _stored_key(self):
+        return self.request_host + '/products'
+
+    def _loadStored(self):
+        """
+        Return (products, expired) from the catalog's disk cache, in this
+        session, or None if it has none
+        """
+        disk_cache = self.catalog.disk_cache
+        if disk_cache is None:
+            return None
+        stored = disk_cache.get(self._stored_key())
+        if stored is None:
+            return None
+        records, expired = stored
+        return ([_rehydrate(record, self) for record in records], expired)
+
+    def _getById(self, id):
+        return self._getS('/products/' + str(id) + '.xml',
+            self.__name__, 'product')
+
+    def _getByHandle(self, handle):
+        return self._getS('/products/handle/' + str(handle) + '.xml',
+            self.__name__, 'product')
 
     def save(self):
-        return self._save('products', 'product')
+        result = self._save('products', 'product')
+        if self.catalog is not None:
+            self.catalog.invalidate(self)
+            if self.catalog.disk_cache is not None:
+                self.catalog.disk_cache.delete(self._stored_key())
+        return result
 
     def getPaymentPageUrl(self):
         return ('https://' + self.request_host + '/h/' +
@@ -427,6 +2903,8 @@ class ChargifyProduct(ChargifyBase):
 
 
 class Usage(object):
+    __slots__ = ('id', 'quantity', 'memo')
+
     def __init__(self, id, memo, quantity):
         self.id = id
         self.quantity = int(quantity)
@@ -445,57 +2923,99 @@ class ChargifySubscription(ChargifyBase):
         'credit_card': 'ChargifyCreditCard'
     }
     __xmlnodename__ = 'subscription'
+    __slots__ = ('id', 'state', 'previous_state', 'balance_in_cents',
+        'total_revenue_in_cents', 'product_price_in_cents',
+        'product_version_number', 'current_period_started_at',
+        'current_period_ends_at', 'next_assessment_at', 'trial_started_at',
+        'trial_ended_at', 'activated_at', 'expires_at', 'created_at',
+        'updated_at', 'canceled_at', 'delayed_cancel_at',
+        'cancellation_message', 'cancellation_method',
+        'cancel_at_end_of_period', 'signup_payment_id', 'signup_revenue',
+        'coupon_code', 'payment_collection_method', 'payment_type',
+        'snap_day', 'reason_code', 'receives_invoice_emails', 'net_terms',
+        'referral_code', 'next_product_id', 'reference', 'customer',
+        'product', 'product_handle', 'credit_card')
+    __defaults__ = {
+        'id': None,
+        'state': '',
+        'balance_in_cents': 0,
+        'current_period_started_at': None,
+        'current_period_ends_at': None,
+        'trial_started_at': None,
+        'trial_ended_attrial_ended_at': None,
+        'activated_at': None,
+        'expires_at': None,
+        'created_at': None,
+        'updated_at': None,
+        'customer': None,
+        'product': None,
+        'product_handle': '',
+        'credit_card': None
+    }
 
-    id = None
-    state = ''
-    balance_in_cents = 0
-    current_period_started_at = None
-    current_period_ends_at = None
-    trial_started_at = None
-    trial_ended_attrial_ended_at = None
-    activated_at = None
-    expires_at = None
-    created_at = None
-    updated_at = None
-    customer = None
-    product = None
-    product_handle = ''
-    credit_card = None
-
-    def __init__(self, apikey, subdomain, nodename=''):
-        super(ChargifySubscription, self).__init__(apikey, subdomain)
+    def __init__(self, apikey=None, subdomain=None, nodename='',
+        session=None):
+        super(ChargifySubscription, self).__init__(apikey, subdomain,
+            session)
         if nodename:
             self.__xmlnodename__ = nodename
 
-    def getAll(self):
-        return self._applyA(self._get('/subscriptions.xml'),
-            self.__name__, 'subscription')
-
-    def createUsage(self, component_id, quantity, memo=None):
+    def getAll(self, identity_map=None, lazy=False):
         """
-        Creates usage for the given component id.
+        With lazy, list calls return lazy records: fields are only decoded
+        when read, for jobs that look at a few fields of many
+        subscriptions.
         """
+        return list(self.iterAll(identity_map=identity_map, lazy=lazy))
 
-        data = '''<?xml version="1.0" encoding="UTF-8"?><usage>
-            <quantity>%d</quantity><memo>%s</memo></usage>''' % (
-                quantity, memo or "")
+    def iterAll(self, per_page=50, prefetch=False, identity_map=None,
+        since=None, lazy=False):
+        return self._iterA(self._since_url('/subscriptions.xml', since),
+            self.__name__, 'subscription', per_page, prefetch, identity_map,
+            lazy)
 
-        dom = minidom.parseString(self.fix_xml_encoding(
-            self._post('/subscriptions/%s/components/%d/usages.xml' % (
-                str(self.id), component_id), data)))
-
-        return [Usage(*tuple(chain.from_iterable([[x.data
-            for x in i.childNodes] or [None] for i in n.childNodes])))
-            for n in dom.getElementsByTagName('usage')]
+    def exportAll(self, per_page=200, window=4, ordered=True,
+        checkpoint=None, identity_map=None, since=None, lazy=False):
+        """
+        Yield every subscription, fetching window pages at a time,
+        resuming from the checkpoint file if one is given, see
+        ChargifyBase._exportA
+        """
+        return self._exportA(self._since_url('/subscriptions.xml', since),
+            self.__name__, 'subscription', per_page, window, ordered,
+            checkpoint, identity_map, lazy)
 
-    def getByCustomerId(self, customer_id):
-        return self._applyA(self._get('/customers/' + str(customer_id) +
-            '/subscriptions.xml'), self.__name__, 'subscription')
+    def createUsage(self, component_id, quantity, memo=None):
+        """
+        Creates usage for the given component id.
+        """
+        data = self.session.codec.dump_fields('usage',
+            [('quantity', int(quantity)), ('memo', memo or '')])
+        url = '/subscriptions/%s/components/%d/usages.xml' % (str(self.id),
+            component_id)
+        return self._instrumented('POST', url, self._createUsage, url, data)
+
+    def _createUsage(self, url, data, event=None):
+        body = self._request('POST', url, data, event)
+        codec = self.session.codec
+        started_at = time.time()
+        body = codec.transcode(body)
+        transcoded_at = time.time()
+        usages = codec.load_usages(body)
+        if event is not None:
+            event['transcode_time'] += transcoded_at - started_at
+            event['parse_time'] += time.time() - transcoded_at
+        return usages
+
+    def getByCustomerId(self, customer_id, identity_map=None, lazy=False):
+        return self._getA('/customers/' + str(customer_id) +
+            '/subscriptions.xml', self.__name__, 'subscription',
+            identity_map, lazy)
 
     def getBySubscriptionId(self, subscription_id):
         #Throws error if more than element is returned
-        i, = self._applyA(self._get('/subscriptions/' + str(subscription_id) +
-            '.xml'), self.__name__, 'subscription')
+        i, = self._getA('/subscriptions/' + str(subscription_id) + '.xml',
+            self.__name__, 'subscription')
         return i
 
     def save(self):
@@ -508,24 +3028,15 @@ class ChargifySubscription(ChargifyBase):
         self._put("/subscriptions/" + self.id + "/reactivate.xml", "")
 
     def upgrade(self, toProductHandle):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-  <subscription>
-    <product_handle>%s</product_handle>
-  </subscription>""" % (toProductHandle)
-        #end improper indentation
-
-        return self._applyS(self._put("/subscriptions/" + self.id + ".xml",
-            xml), self.__name__, "subscription")
+        data = self.session.codec.dump_fields('subscription',
+            [('product_handle', toProductHandle)])
+        return self._requestS('PUT', "/subscriptions/" + self.id + ".xml",
+            data, self.__name__, "subscription")
 
     def unsubscribe(self, message):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-<subscription>
-  <cancellation_message>
-    %s
-  </cancellation_message>
-</subscription>""" % (message)
-
-        self._delete("/subscriptions/" + self.id + ".xml", xml)
+        data = self.session.codec.dump_fields('subscription',
+            [('cancellation_message', message)])
+        self._delete("/subscriptions/" + self.id + ".xml", data)
 
 
 class ChargifyCreditCard(ChargifyBase):
@@ -535,48 +3046,51 @@ class ChargifyCreditCard(ChargifyBase):
     __name__ = 'ChargifyCreditCard'
     __attribute_types__ = {}
     __xmlnodename__ = 'credit_card_attributes'
+    __slots__ = ('id', 'first_name', 'last_name', 'full_number',
+        'masked_card_number', 'expiration_month', 'expiration_year', 'cvv',
+        'type', 'card_type', 'customer_id', 'current_vault', 'vault_token',
+        'customer_vault_token', 'billing_address', 'billing_address_2',
+        'billing_city', 'billing_state', 'billing_zip', 'billing_country',
+        'zip', 'payment_type')
+    __defaults__ = {
+        'id': None,
+        'first_name': '',
+        'last_name': '',
+        'full_number': '',
+        'masked_card_number': '',
+        'expiration_month': '',
+        'expiration_year': '',
+        'cvv': '',
+        'type': '',
+        'billing_address': '',
+        'billing_city': '',
+        'billing_state': '',
+        'billing_zip': '',
+        'billing_country': '',
+        'zip': ''
+    }
 
-    first_name = ''
-    last_name = ''
-    full_number = ''
-    masked_card_number = ''
-    expiration_month = ''
-    expiration_year = ''
-    cvv = ''
-    type = ''
-    billing_address = ''
-    billing_city = ''
-    billing_state = ''
-    billing_zip = ''
-    billing_country = ''
-    zip = ''
-
-    def __init__(self, apikey, subdomain, nodename=''):
-        super(ChargifyCreditCard, self).__init__(apikey, subdomain)
+    def __init__(self, apikey=None, subdomain=None, nodename='',
+        session=None):
+        super(ChargifyCreditCard, self).__init__(apikey, subdomain, session)
         if nodename:
             self.__xmlnodename__ = nodename
 
     def save(self, subscription):
         path = "/subscriptions/%s.xml" % (subscription.id)
 
-        data = u"""<?xml version="1.0" encoding="UTF-8"?>
-  <subscription>
-    <credit_card_attributes>
-      <full_number>%s</full_number>
-      <expiration_month>%s</expiration_month>
-      <expiration_year>%s</expiration_year>
-      <cvv>%s</cvv>
-      <first_name>%s</first_name>
-      <last_name>%s</last_name>
-      <zip>%s</zip>
-    </credit_card_attributes>
-  </subscription>""" % (self.full_number, self.expiration_month,
-          self.expiration_year, self.cvv, self.first_name,
-          self.last_name, self.zip)
-        # end improper indentation
-
-        return self._applyS(self._put(path, data),
-            self.__name__, "subscription")
+        data = self.session.codec.dump_fields('subscription', [
+            ('credit_card_attributes', [
+                ('full_number', self.full_number),
+                ('expiration_month', self.expiration_month),
+                ('expiration_year', self.expiration_year),
+                ('cvv', self.cvv),
+                ('first_name', self.first_name),
+                ('last_name', self.last_name),
+                ('zip', self.zip)])])
+
+        return self._requestS('PUT', path, data, self.__name__,
+            "subscription")
 
 
 class ChargifyPostBack(ChargifyBase):
@@ -584,21 +3098,176 @@ class ChargifyPostBack(ChargifyBase):
     Represents Chargify API Post Backs
     @license    GNU General Public License
     """
-    subscriptions = []
 
-    def __init__(self, apikey, subdomain, postback_data):
-        ChargifyBase.__init__(apikey, subdomain)
+    def __init__(self, apikey, subdomain, postback_data, concurrency=10,
+        session=None):
+        ChargifyBase.__init__(self, apikey, subdomain, session)
+        self.concurrency = concurrency
+        self.subscriptions = []
+        self.failures = []
         if postback_data:
             self._process_postback_data(postback_data)
 
     def _process_postback_data(self, data):
         """
-        Process the Json array and fetches the Subscription Objects
+        Process the Json array and fetches the Subscription Objects, up to
+        concurrency at a time. Subscriptions are kept in the order of the
+        array with duplicate ids removed; ids that could not be fetched are
+        kept in failures as (id, exception) tuples instead.
+        """
+        csub = self._new(ChargifySubscription)
+        ids = []
+        seen = set()
+        for obj in json.loads(data):
+            if obj not in seen:
+                seen.add(obj)
+                ids.append(obj)
+        if not ids:
+            return
+
+        def fetch(subscription_id):
+            try:
+                return (csub.getBySubscriptionId(subscription_id), None)
+            except Exception, e:
+                return (None, e)
+
+        workers = ThreadPool(max(1, min(self.concurrency, len(ids))))
+        try:
+            results = workers.map(fetch, ids)
+        finally:
+            workers.close()
+            workers.join()
+
+        for subscription_id, (subscription, error) in zip(ids, results):
+            if error is None:
+                self.subscriptions.append(subscription)
+            else:
+                self.failures.append((subscription_id, error))
+
+
+class ChargifyUsageRecorder(object):
+    """
+    Buffers usage for ChargifySubscription.createUsage. Quantities recorded
+    for the same subscription and component are added up, and their memos
+    joined, until max_pending subscription/component pairs are buffered or
+    interval seconds have passed. A background thread then sends them, up
+    to concurrency requests at a time. close() sends whatever is left; it
+    is called on leaving a with block and, for recorders still open, when
+    the interpreter exits.
+
+    callback, if given, is called with (subscription_id, component_id,
+    quantity, memo, result, error) for every request sent; error is None
+    when it succeeded and result is None when it didn't.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, subscription, max_pending=100, interval=5,
+        concurrency=4, callback=None):
+        """
+        subscription is the ChargifySubscription whose credentials and
+        connections are used to send the usage
+        """
+        self.max_pending = max_pending
+        self.interval = interval
+        self.callback = callback
+        self._subscription = subscription
+        # (subscription id, component id) -> [quantity, memos]
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._workers = ThreadPool(concurrency)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _usage_recorders.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, subscription_id, component_id, quantity, memo=None):
+        """
+        Buffer usage of a component
         """
-        csub = ChargifySubscription(self.api_key, self.sub_domain)
-        postdata_objects = json.loads(data)
-        for obj in postdata_objects:
-            self.subscriptions.append(csub.getBySubscriptionId(obj))
+        with self._lock:
+            if self._closed:
+                raise ChargifyError('The usage recorder has been closed')
+            key = (subscription_id, component_id)
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = self._pending[key] = [0, []]
+            entry[0] += quantity
+            if memo and memo not in entry[1]:
+                entry[1].append(memo)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def flush(self, wait=False):
+        """
+        Send everything buffered so far; with wait, return once it has
+        been sent
+        """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        results = [self._workers.apply_async(self._send,
+            (subscription_id, component_id, quantity, memos))
+            for (subscription_id, component_id), (quantity, memos)
+            in pending.iteritems()]
+        if wait:
+            for result in results:
+                result.wait()
+
+    def close(self):
+        """
+        Stop the background thread and send whatever is left
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._workers.close()
+        self._workers.join()
+        _usage_recorders.discard(self)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._closed:
+                self.flush()
+
+    def _send(self, subscription_id, component_id, quantity, memos):
+        memo = '; '.join(memos) or None
+        subscription = self._subscription._new(ChargifySubscription)
+        subscription.id = subscription_id
+        try:
+            result = subscription.createUsage(component_id, quantity, memo)
+            error = None
+        except Exception, e:
+            result = None
+            error = e
+        if self.callback:
+            self.callback(subscription_id, component_id, quantity, memo,
+                result, error)
+
+
+# Usage recorders that haven't been closed; their background threads are
+# daemons, so what they buffered would be lost at exit without this
+_usage_recorders = weakref.WeakSet()
+
+
+def _close_usage_recorders():
+    for recorder in list(_usage_recorders):
+        recorder.close()
+
+atexit.register(_close_usage_recorders)
 
 
 class Chargify:
@@ -609,36 +3278,170 @@ class Chargify:
     api_key = ''
     sub_domain = ''
 
-    def __init__(self, apikey=None, subdomain=None, cred_file=None):
+    def __init__(self, apikey=None, subdomain=None, cred_file=None,
+        product_catalog=None, identity_map=None, response_cache=None,
+        rate_limiter=None, instrument=None, codec=None, parse_executor=None):
         ''' We take either an api_key and sub_domain, or a path
         to a file with JSON that defines those two, or we throw
-        an error.'''
-
-        if self.api_key and self.sub_domain:
+        an error. Pass a ChargifyProductCatalog to cache products, a
+        ChargifyIdentityMap to share nested products and customers, a
+        ChargifyResponseCache to poll endpoints conditionally, a
+        ChargifyRateLimiter to throttle and retry requests, an
+        instrument (e.g. a ChargifyMetrics) to observe them, a
+        ChargifyJSONCodec to talk JSON instead of XML and a
+        ChargifyParseExecutor to parse large responses on other cores.'''
+
+        if apikey and subdomain:
             self.api_key = apikey
             self.sub_domain = subdomain
-            return
         elif cred_file:
             f = open(cred_file)
             credentials = json.loads(f.read())
             self.api_key = credentials['api_key']
             self.sub_domain = credentials['sub_domain']
-            return
         else:
             print "Need either an api_key and subdomain, or credential file. Exiting."
             exit()
 
+        self.session = self._create_session(product_catalog, identity_map,
+            response_cache, rate_limiter, instrument, codec, parse_executor)
+
+    def _create_session(self, product_catalog, identity_map,
+        response_cache, rate_limiter, instrument, codec, parse_executor):
+        return ChargifySession(self.api_key, self.sub_domain,
+            product_catalog=product_catalog, identity_map=identity_map,
+            response_cache=response_cache, rate_limiter=rate_limiter,
+            instrument=instrument, codec=codec,
+            parse_executor=parse_executor)
+
+    def Customer(self, nodename=''):
+        return ChargifyCustomer(nodename=nodename, session=self.session)
+
+    def Product(self, nodename=''):
+        return ChargifyProduct(nodename=nodename, session=self.session)
+
+    def Subscription(self, nodename=''):
+        return ChargifySubscription(nodename=nodename, session=self.session)
+
+    def CreditCard(self, nodename=''):
+        return ChargifyCreditCard(nodename=nodename, session=self.session)
+
+    def PostBack(self, postbackdata, concurrency=10):
+        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata,
+            concurrency, self.session)
+
+    def UsageRecorder(self, max_pending=100, interval=5, concurrency=4,
+        callback=None):
+        return ChargifyUsageRecorder(self.Subscription(), max_pending,
+            interval, concurrency, callback)
+
+
+class AsyncChargifyObject(object):
+    """
+    Wraps a model object so that its API calls run on a pool of worker
+    threads. Calling a method returns an AsyncResult straight away; its
+    get() waits for and returns the result, with any model objects in it
+    wrapped in turn. Methods that return generators, like iterAll, are
+    run to the end in the worker and get() returns a list. Methods that
+    don't talk to the API (the model's __local__) are called straight
+    away. Other attributes are read from and set on the wrapped object.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, obj, workers):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_workers', workers)
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if name.startswith('_'):
+            return value
+        elif not callable(value):
+            return self._wrap(value)
+        elif name in self._obj.__local__:
+            return lambda *args, **kwargs: self._wrap(value(*args, **kwargs))
+
+        def call(*args, **kwargs):
+            return self._workers.apply_async(self._call, (value, args, kwargs))
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+    def _wrap(self, value):
+        if isinstance(value, ChargifyBase):
+            return AsyncChargifyObject(value, self._workers)
+        elif isinstance(value, list):
+            return [self._wrap(i) for i in value]
+        elif isinstance(value, tuple):
+            return tuple([self._wrap(i) for i in value])
+        return value
+
+    def _call(self, method, args, kwargs):
+        result = method(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            # Fetch every page here rather than in the caller's thread
+            result = list(result)
+        return self._wrap(result)
+
+
+class AsyncChargify(Chargify):
+    """
+    A Chargify entry point whose objects don't block: their methods return
+    an AsyncResult (see AsyncChargifyObject). At most concurrency calls are
+    in flight at once, over a connection pool of its own. host and secure
+    point the client at another server, e.g. a local stub.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, apikey=None, subdomain=None, cred_file=None,
+        product_catalog=None, concurrency=10, host=None, secure=True,
+        identity_map=None, response_cache=None, rate_limiter=None,
+        instrument=None, codec=None, parse_executor=None):
+        self.concurrency = concurrency
+        self.host = host
+        self.secure = secure
+        Chargify.__init__(self, apikey, subdomain, cred_file,
+            product_catalog, identity_map, response_cache, rate_limiter,
+            instrument, codec, parse_executor)
+        self._workers = ThreadPool(concurrency)
+
+    def _create_session(self, product_catalog, identity_map,
+        response_cache, rate_limiter, instrument, codec, parse_executor):
+        return ChargifySession(self.api_key, self.sub_domain, self.host,
+            ChargifyConnectionPool(max_size=self.concurrency,
+                secure=self.secure), product_catalog, identity_map,
+            response_cache, rate_limiter, instrument, codec, parse_executor)
+
+    def _wrap(self, obj):
+        return AsyncChargifyObject(obj, self._workers)
+
     def Customer(self, nodename=''):
-        return ChargifyCustomer(self.api_key, self.sub_domain, nodename)
+        return self._wrap(Chargify.Customer(self, nodename))
 
     def Product(self, nodename=''):
-        return ChargifyProduct(self.api_key, self.sub_domain, nodename)
+        return self._wrap(Chargify.Product(self, nodename))
 
     def Subscription(self, nodename=''):
-        return ChargifySubscription(self.api_key, self.sub_domain, nodename)
+        return self._wrap(Chargify.Subscription(self, nodename))
 
     def CreditCard(self, nodename=''):
-        return ChargifyCreditCard(self.api_key, self.sub_domain, nodename)
+        return self._wrap(Chargify.CreditCard(self, nodename))
 
-    def PostBack(self, postbackdata):
-        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata)
+    def PostBack(self, postbackdata, concurrency=10):
+        postback = ChargifyPostBack(self.api_key, self.sub_domain, None,
+            concurrency, self.session)
+        return self._workers.apply_async(self._process_postback,
+            (postback, postbackdata))
+
+    def _process_postback(self, postback, postbackdata):
+        postback._process_postback_data(postbackdata)
+        return postback
+
+    def close(self):
+        """
+        Wait for the calls in flight and shut the worker threads down
+        """
+        self._workers.close()
+        self._workers.join()
+        self.session.connection_pool.clear()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+''' Synthetic Chargify responses for the benchmarks.
+    The same count always gives the same bytes, so the checked-in fixtures
+    can be rebuilt and the 100k response, too big to check in, generated
+    on the fly.
+
+    Rebuild the checked-in fixtures with: python benchmarks/fixtures.py
+'''
+
+import json
+import os
+import random
+from collections import OrderedDict
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'data')
+
+# Sizes with a checked-in fixture; anything else is generated
+CHECKED_IN = (1, 1000)
+
+CUSTOMER = '''    <customer>
+      <id>%(customer)d</id>
+      <first_name>%(first_name)s</first_name>
+      <last_name>%(last_name)s</last_name>
+      <email>customer%(customer)d@example.com</email>
+      <organization>%(organization)s</organization>
+      <reference>ref-%(customer)d</reference>
+      <created_at type="datetime">%(started)s</created_at>
+      <updated_at type="datetime">%(updated)s</updated_at>
+    </customer>
+'''
+
+PRODUCT = '''    <product>
+      <id>%(product)d</id>
+      <name>Plan %(product)d</name>
+      <handle>plan-%(product)d</handle>
+      <price_in_cents type="integer">%(price)d</price_in_cents>
+      <interval_unit>month</interval_unit>
+      <interval type="integer">1</interval>
+      <accounting_code></accounting_code>
+    </product>
+'''
+
+SUBSCRIPTION = '''  <subscription>
+    <id>%(id)d</id>
+    <state>%(state)s</state>
+    <balance_in_cents type="integer">%(balance)d</balance_in_cents>
+    <current_period_started_at type="datetime">%(started)s</current_period_started_at>
+    <current_period_ends_at type="datetime">%(ends)s</current_period_ends_at>
+    <created_at type="datetime">%(started)s</created_at>
+    <updated_at type="datetime">%(updated)s</updated_at>
+''' + CUSTOMER + PRODUCT + '''  </subscription>
+'''
+
+STATES = ('active', 'active', 'active', 'trialing', 'past_due', 'canceled')
+FIRST_NAMES = ('John', 'Jane', 'Paul', 'Mary', 'Ahmed', 'Li')
+LAST_NAMES = ('Doe', 'Smith', 'Trippett', 'Nguyen', 'Garcia')
+ORGANIZATIONS = ('', '', 'Acme', 'Initech', 'Smith &amp; Sons')
+
+
+def _timestamp(rng):
+    return '2010-%02d-%02dT%02d:%02d:%02d-05:00' % (rng.randint(1, 12),
+        rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59),
+        rng.randint(0, 59))
+
+
+def make_fields(rng, i, first_name=None):
+    ''' Return the template fields of the i'th subscription, drawing its
+        values from rng. '''
+    started = _timestamp(rng)
+    first_name = first_name or rng.choice(FIRST_NAMES)
+    return {'id': i + 1, 'state': rng.choice(STATES),
+        'balance': rng.choice((0, 0, 0, 1000, 2500)),
+        'started': started, 'ends': started.replace('2010', '2011'),
+        'updated': _timestamp(rng), 'customer': i // 3 + 1,
+        'first_name': first_name, 'last_name': rng.choice(LAST_NAMES),
+        'organization': rng.choice(ORGANIZATIONS),
+        'product': i % 5 + 1, 'price': (i % 5 + 1) * 1000}
+
+
+def customer_json(fields):
+    ''' The JSON counterpart of CUSTOMER '''
+    return OrderedDict([('id', fields['customer']),
+        ('first_name', fields['first_name']),
+        ('last_name', fields['last_name']),
+        ('email', 'customer%(customer)d@example.com' % fields),
+        ('organization', fields['organization'].replace('&amp;', '&')),
+        ('reference', 'ref-%(customer)d' % fields),
+        ('created_at', fields['started']),
+        ('updated_at', fields['updated'])])
+
+
+def product_json(fields):
+    ''' The JSON counterpart of PRODUCT '''
+    return OrderedDict([('id', fields['product']),
+        ('name', 'Plan %(product)d' % fields),
+        ('handle', 'plan-%(product)d' % fields),
+        ('price_in_cents', fields['price']),
+        ('interval_unit', 'month'),
+        ('interval', 1),
+        ('accounting_code', None)])
+
+
+def subscription_json(fields):
+    ''' The JSON counterpart of SUBSCRIPTION '''
+    return OrderedDict([('id', fields['id']),
+        ('state', fields['state']),
+        ('balance_in_cents', fields['balance']),
+        ('current_period_started_at', fields['started']),
+        ('current_period_ends_at', fields['ends']),
+        ('created_at', fields['started']),
+        ('updated_at', fields['updated']),
+        ('customer', customer_json(fields)),
+        ('product', product_json(fields))])
+
+
+def make_response(count, first_name=None, format='xml'):
+    ''' Build a /subscriptions.xml (or .json) style response with count
+        records. Pass first_name to give every customer the same first
+        name. Both formats hold the same records. '''
+    rng = random.Random(count)
+    fields = [make_fields(rng, i, first_name) for i in xrange(count)]
+    if format == 'json':
+        return json.dumps([{'subscription': subscription_json(f)}
+            for f in fields])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<subscriptions type="array">\n' +
+        ''.join([SUBSCRIPTION % f for f in fields]) +
+        '</subscriptions>\n')
+
+
+def fixture_path(count, format='xml'):
+    return os.path.join(FIXTURE_DIR, 'subscriptions_%d.%s' % (count, format))
+
+
+def load(count, format='xml'):
+    ''' Return the response with count records, from its checked-in
+        fixture if there is one. '''
+    if count in CHECKED_IN:
+        f = open(fixture_path(count, format), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    return make_response(count, format=format)
+
+
+def write_fixtures():
+    if not os.path.isdir(FIXTURE_DIR):
+        os.makedirs(FIXTURE_DIR)
+    for count in CHECKED_IN:
+        for format in ('xml', 'json'):
+            f = open(fixture_path(count, format), 'wb')
+            try:
+                f.write(make_response(count, format=format))
+            finally:
+                f.close()
+
+
+if __name__ == "__main__":
+    write_fixtures()
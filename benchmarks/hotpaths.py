@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+''' Offline benchmarks for the parse, serialize and date decoding hot paths.
+    Every benchmark runs in a child process of its own so its peak memory
+    (ru_maxrss) can be told apart from the others'. Results are compared
+    with a saved baseline and regressions make the run fail. The .json
+    rows decode the same records in JSON, for comparison with the XML rows,
+    and scan.lazy reads the fields scan reads from lazy records.
+
+    Run me from the top of the checkout:
+        python benchmarks/hotpaths.py                  compare with baseline
+        python benchmarks/hotpaths.py --save-baseline  record a new baseline
+        python benchmarks/hotpaths.py --large          include 100k records
+'''
+
+import json
+import multiprocessing
+import optparse
+import os
+import re
+import resource
+import sys
+import timeit
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import api
+import iso8601
+import fixtures
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'baseline.json')
+
+_datetime_rx = re.compile(r'type="datetime">([^<]+)<')
+
+
+def _subscription(codec=None):
+    return api.ChargifySubscription(session=api.ChargifySession('benchmark',
+        'benchmark', codec=codec))
+
+
+def bench_fix_xml_encoding(xml):
+    base = _subscription()
+    return lambda: base.fix_xml_encoding(xml)
+
+
+def bench_parse(xml):
+    ''' The object mapper alone, on already transcoded xml '''
+    base = _subscription()
+    xml = base.fix_xml_encoding(xml)
+
+    def run():
+        parser = api.ChargifyXMLParser(base, 'ChargifySubscription',
+            'subscription')
+        parser.feed(xml)
+        return parser.close()
+    return run
+
+
+def bench_applyA(xml):
+    base = _subscription()
+    return lambda: base._applyA(xml, 'ChargifySubscription', 'subscription')
+
+
+def bench_parse_json(data):
+    ''' The JSON object mapper, the counterpart of parse '''
+    base = _subscription(api.ChargifyJSONCodec())
+
+    def run():
+        parser = api.ChargifyJSONParser(base, 'ChargifySubscription',
+            'subscription')
+        parser.feed(data)
+        return parser.close()
+    return run
+
+
+def bench_applyA_json(data):
+    base = _subscription(api.ChargifyJSONCodec())
+    return lambda: base._applyA(data, 'ChargifySubscription',
+        'subscription')
+
+
+def _scan(xml, lazy):
+    ''' A bulk job reading three fields of every subscription '''
+    base = _subscription()
+
+    def run():
+        for obj in base._applyA(xml, 'ChargifySubscription', 'subscription',
+            lazy=lazy):
+            obj.id, obj.state, obj.current_period_ends_at
+    return run
+
+
+def bench_scan(xml):
+    return _scan(xml, False)
+
+
+def bench_scan_lazy(xml):
+    return _scan(xml, True)
+
+
+def bench_applyS(xml):
+    ''' _applyS on every record of the response, one response each '''
+    base = _subscription()
+    body = xml[xml.index('<subscription>'):xml.rindex('</subscriptions>')]
+    records = ['<?xml version="1.0" encoding="UTF-8"?>\n' + record +
+        '</subscription>\n' for record in body.split('</subscription>\n')[:-1]]
+
+    def run():
+        for record in records:
+            base._applyS(record, 'ChargifySubscription', 'subscription')
+    return run
+
+
+def bench_toxml(xml):
+    objs = _subscription()._applyA(xml, 'ChargifySubscription',
+        'subscription')
+
+    def run():
+        for obj in objs:
+            obj._toxml()
+    return run
+
+
+def bench_save(xml):
+    ''' _save of every record: serialize, then parse the echoed record.
+        Requests are answered with a canned response instead of going over
+        the wire. '''
+    objs = _subscription()._applyA(xml, 'ChargifySubscription',
+        'subscription')
+    response = fixtures.load(1)
+    for obj in objs:
+        obj._request = lambda method, url, data='', event=None: response
+
+    def run():
+        for obj in objs:
+            obj._save('subscriptions', 'subscription')
+    return run
+
+
+def bench_iso8601(xml):
+    values = _datetime_rx.findall(xml)
+    parse = iso8601.parse
+
+    def run():
+        for value in values:
+            parse(value)
+    return run
+
+
+# Name, setup, format of the response it's given
+BENCHMARKS = [
+    ('fix_xml_encoding', bench_fix_xml_encoding, 'xml'),
+    ('parse', bench_parse, 'xml'),
+    ('parse.json', bench_parse_json, 'json'),
+    ('_applyA', bench_applyA, 'xml'),
+    ('_applyA.json', bench_applyA_json, 'json'),
+    ('scan', bench_scan, 'xml'),
+    ('scan.lazy', bench_scan_lazy, 'xml'),
+    ('_applyS', bench_applyS, 'xml'),
+    ('_toxml', bench_toxml, 'xml'),
+    ('_save', bench_save, 'xml'),
+    ('iso8601.parse', bench_iso8601, 'xml'),
+]
+
+
+def _count_items(name, xml, count):
+    if name == 'iso8601.parse':
+        return len(_datetime_rx.findall(xml))
+    return count
+
+
+def _run_one(name, count, repeat, queue):
+    ''' Child process body: time one benchmark and report the peak RSS of
+        a single run '''
+    try:
+        setup, format = [(setup, format) for n, setup, format in
+            BENCHMARKS if n == name][0]
+        xml = fixtures.load(count, format)
+        run = setup(xml)
+        run()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Loop fast benchmarks enough to rise above timer noise
+        number = 1
+        while timeit.timeit(run, number=number) < 0.2:
+            number *= 10
+        seconds = min(timeit.repeat(run, number=number,
+            repeat=repeat)) / number
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        return
+    queue.put({'seconds': seconds,
+        'items_per_sec': _count_items(name, xml, count) / seconds,
+        'mb_per_sec': len(xml) / 1048576.0 / seconds,
+        'peak_rss_kb': peak_rss})
+
+
+def run_benchmark(name, count, repeat):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_one,
+        args=(name, count, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('%s/%d failed:\n%s' % (name, count,
+            result['error']))
+    return result
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--large', action='store_true', default=False,
+        help='also run the 100k record response')
+    parser.add_option('--repeat', type='int', default=5,
+        help='runs per benchmark, the best one counts')
+    parser.add_option('--baseline', default=BASELINE,
+        help='baseline file to compare with or save to')
+    parser.add_option('--save-baseline', action='store_true', default=False,
+        help='save the results as the new baseline')
+    parser.add_option('--tolerance', type='float', default=0.4,
+        help='slowdown or memory growth that counts as a regression')
+    options, args = parser.parse_args()
+
+    counts = [1, 1000]
+    if options.large:
+        counts.append(100000)
+    baseline = load_baseline(options.baseline)
+    results = {}
+    regressions = []
+
+    print "%-18s %7s %10s %12s %9s %10s  %s" % ('benchmark', 'records',
+        'ms', 'items/s', 'MB/s', 'peak KB', 'vs baseline')
+    for name, setup, format in BENCHMARKS:
+        for count in counts:
+            key = '%s/%d' % (name, count)
+            result = run_benchmark(name, count,
+                count >= 100000 and 1 or options.repeat)
+            results[key] = result
+
+            change = ''
+            if key in baseline:
+                old = baseline[key]
+                slower = result['seconds'] / old['seconds'] - 1
+                bigger = float(result['peak_rss_kb']) / \
+                    old['peak_rss_kb'] - 1
+                change = '%+.0f%% time, %+.0f%% memory' % (slower * 100,
+                    bigger * 100)
+                # Single record timings are too noisy to fail a run on
+                if count > 1 and (slower > options.tolerance or
+                    bigger > options.tolerance):
+                    regressions.append(key)
+                    change += '  REGRESSION'
+            print "%-18s %7d %10.2f %12.0f %9.1f %10d  %s" % (name, count,
+                result['seconds'] * 1000, result['items_per_sec'],
+                result['mb_per_sec'], result['peak_rss_kb'], change)
+
+    if options.save_baseline:
+        baseline.update(results)
+        f = open(options.baseline, 'w')
+        try:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        print "Saved baseline to %s" % options.baseline
+    elif regressions:
+        print "%d regression(s): %s" % (len(regressions),
+            ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
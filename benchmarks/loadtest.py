@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+''' Drive the Chargify facade against the stub server at a fixed
+    concurrency and report requests per second and latency percentiles.
+    A mix of reads, list pages and writes goes through the connection
+    pool, the rate limiter's retries and the parser, like real traffic.
+
+    Run me from the top of the checkout:
+        python benchmarks/loadtest.py --concurrency 20 --requests 5000
+        python benchmarks/loadtest.py --latency 0.02 --error-rate 0.05 \\
+            --retries 3
+        python benchmarks/loadtest.py --host 127.0.0.1:8080
+        python benchmarks/loadtest.py --ops subscription_page \\
+            --per-page 200 --parse-processes 4
+
+    Without --host a stub server is started in-process with the given
+    latency, error and payload settings.
+'''
+
+import optparse
+import os
+import random
+import ssl
+import sys
+import threading
+import time
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import api
+from stubserver import StubServer
+
+
+class LoadTestChargify(api.Chargify):
+    ''' A Chargify entry point talking to host over a pool of concurrency
+        connections '''
+
+    def __init__(self, host, secure=False, concurrency=10, ssl_context=None,
+        rate_limiter=None, instrument=None, codec=None, parse_executor=None):
+        self.host = host
+        self.secure = secure
+        self.concurrency = concurrency
+        self.ssl_context = ssl_context
+        api.Chargify.__init__(self, 'loadtest', 'loadtest',
+            rate_limiter=rate_limiter, instrument=instrument, codec=codec,
+            parse_executor=parse_executor)
+
+    def _create_session(self, product_catalog, identity_map,
+        response_cache, rate_limiter, instrument, codec, parse_executor):
+        return api.ChargifySession(self.api_key, self.sub_domain, self.host,
+            api.ChargifyConnectionPool(max_size=self.concurrency,
+                secure=self.secure, ssl_context=self.ssl_context),
+            rate_limiter=rate_limiter, instrument=instrument, codec=codec,
+            parse_executor=parse_executor)
+
+
+def _subscription(chargify, options, rng):
+    subscription = chargify.Subscription()
+    subscription.id = str(rng.randint(1, options.records))
+    return subscription
+
+
+def _customer(chargify, options, rng):
+    customer = chargify.Customer()
+    customer.id = str(rng.randint(1, (options.records + 2) // 3))
+    return customer
+
+
+def op_subscription(chargify, options, rng):
+    chargify.Subscription().getBySubscriptionId(
+        rng.randint(1, options.records))
+
+
+def op_subscription_page(chargify, options, rng):
+    list(islice(chargify.Subscription().iterAll(options.per_page),
+        options.per_page))
+
+
+def op_customer(chargify, options, rng):
+    chargify.Customer().getById(_customer(chargify, options, rng).id)
+
+
+def op_customer_lookup(chargify, options, rng):
+    chargify.Customer().getByReference(
+        'ref-' + _customer(chargify, options, rng).id)
+
+
+def op_customer_subscriptions(chargify, options, rng):
+    _customer(chargify, options, rng).getSubscriptions()
+
+
+def op_customer_save(chargify, options, rng):
+    customer = _customer(chargify, options, rng)
+    customer.first_name = 'Load'
+    customer.last_name = 'Test'
+    customer.email = 'load@example.com'
+    customer.save()
+
+
+def op_product_handle(chargify, options, rng):
+    chargify.Product().getByHandle('plan-%d' % rng.randint(1, 5))
+
+
+def op_usage(chargify, options, rng):
+    _subscription(chargify, options, rng).createUsage(1,
+        rng.randint(1, 10), 'load test')
+
+
+def op_reset_balance(chargify, options, rng):
+    _subscription(chargify, options, rng).resetBalance()
+
+
+def op_reactivate(chargify, options, rng):
+    _subscription(chargify, options, rng).reactivate()
+
+
+# Operation, relative weight
+OPERATIONS = [
+    ('subscription', op_subscription, 30),
+    ('subscription_page', op_subscription_page, 5),
+    ('customer', op_customer, 15),
+    ('customer_lookup', op_customer_lookup, 10),
+    ('customer_subscriptions', op_customer_subscriptions, 10),
+    ('customer_save', op_customer_save, 5),
+    ('product_handle', op_product_handle, 10),
+    ('usage', op_usage, 10),
+    ('reset_balance', op_reset_balance, 3),
+    ('reactivate', op_reactivate, 2),
+]
+
+
+def percentile(values, p):
+    ''' The p'th percentile of the sorted values '''
+    if not values:
+        return 0
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+class LoadTest(object):
+    ''' Runs operations from concurrency threads until requests have been
+        made or duration seconds have passed, whichever comes first '''
+
+    def __init__(self, chargify, options, operations):
+        self.chargify = chargify
+        self.options = options
+        self.operations = operations
+        self.latencies = dict([(name, []) for name, op, w in operations])
+        self.errors = {}
+        self._issued = 0
+        self._lock = threading.Lock()
+        self._choices = []
+        for name, op, weight in operations:
+            self._choices.extend([(name, op)] * weight)
+
+    def _next(self):
+        with self._lock:
+            if self._issued >= self.options.requests or \
+                time.time() >= self._deadline:
+                return False
+            self._issued += 1
+            return True
+
+    def _work(self, seed):
+        rng = random.Random(seed)
+        while self._next():
+            name, op = rng.choice(self._choices)
+            start = time.time()
+            try:
+                op(self.chargify, self.options, rng)
+                error = None
+            except Exception, e:
+                error = e.__class__.__name__
+            elapsed = time.time() - start
+            with self._lock:
+                self.latencies[name].append(elapsed)
+                if error is not None:
+                    self.errors[error] = self.errors.get(error, 0) + 1
+
+    def run(self):
+        self._deadline = time.time() + (self.options.duration or 1e9)
+        threads = [threading.Thread(target=self._work, args=(seed,))
+            for seed in xrange(self.options.concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+
+    def report(self, server=None):
+        print "%-24s %7s %8s %8s %8s %8s" % ('operation', 'count',
+            'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+        everything = []
+        for name, op, weight in self.operations:
+            latencies = sorted(self.latencies[name])
+            everything.extend(latencies)
+            if latencies:
+                self._row(name, latencies)
+        everything.sort()
+        self._row('all', everything)
+
+        print
+        print "%d operations in %.2f s: %.1f operations/s" % (
+            len(everything), self.elapsed, len(everything) / self.elapsed)
+        if server is not None:
+            print "%(requests)d HTTP requests over %(connections)d " \
+                "connections, %(errors)d injected errors, %(bytes)d " \
+                "response bytes" % server.stats
+            print "%.1f HTTP requests/s" % (
+                server.stats['requests'] / self.elapsed)
+        limiter = self.chargify.session.rate_limiter
+        if limiter is not None:
+            print "Rate limiter: %r" % limiter.stats()
+        for name, count in sorted(self.errors.items()):
+            print "%d operations failed with %s" % (count, name)
+
+    def _row(self, name, latencies):
+        print "%-24s %7d %8.1f %8.1f %8.1f %8.1f" % (name, len(latencies),
+            percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, latencies[-1] * 1000)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', help='host:port of a running stub server, '
+        'instead of starting one in-process')
+    parser.add_option('--https', action='store_true', default=False,
+        help='talk HTTPS, without verifying the certificate')
+    parser.add_option('--concurrency', type='int', default=10)
+    parser.add_option('--requests', type='int', default=2000,
+        help='operations to run')
+    parser.add_option('--duration', type='float',
+        help='stop after that many seconds')
+    parser.add_option('--ops', help='comma separated operations to run, '
+        'of: ' + ', '.join([name for name, op, w in OPERATIONS]))
+    parser.add_option('--per-page', type='int', default=50,
+        help='page size of subscription_page')
+    parser.add_option('--rate', type='float',
+        help='client side limit in requests per second')
+    parser.add_option('--retries', type='int', default=0,
+        help='retries of failed requests')
+    parser.add_option('--backoff', type='float', default=0.05,
+        help='base retry delay in seconds')
+    parser.add_option('--metrics', action='store_true', default=False,
+        help='also report the client\'s per endpoint metrics')
+    parser.add_option('--format', choices=('xml', 'json'), default='xml',
+        help='wire format to talk, xml or json')
+    parser.add_option('--parse-processes', type='int', default=0,
+        help='parse large responses in that many worker processes')
+    parser.add_option('--parse-threshold', type='int', default=256 * 1024,
+        help='size in bytes from which responses go to the workers')
+    group = optparse.OptionGroup(parser, 'In-process stub server')
+    group.add_option('--records', type='int', default=1000)
+    group.add_option('--latency', type='float', default=0)
+    group.add_option('--jitter', type='float', default=0)
+    group.add_option('--error-rate', type='float', default=0)
+    group.add_option('--error-status', type='int', action='append',
+        dest='error_statuses')
+    group.add_option('--retry-after', type='float')
+    group.add_option('--padding', type='int', default=0)
+    group.add_option('--compress', action='store_true', default=False)
+    group.add_option('--certfile')
+    group.add_option('--keyfile')
+    parser.add_option_group(group)
+    options, args = parser.parse_args()
+
+    operations = OPERATIONS
+    if options.ops:
+        names = options.ops.split(',')
+        operations = [o for o in OPERATIONS if o[0] in names]
+
+    server = None
+    host = options.host
+    if host is None:
+        server = StubServer(('127.0.0.1', 0), options.records,
+            options.latency, options.jitter, options.error_rate,
+            tuple(options.error_statuses or (503,)), options.retry_after,
+            padding=options.padding, certfile=options.certfile,
+            keyfile=options.keyfile, compress=options.compress)
+        host = '127.0.0.1:%d' % server.start()
+
+    ssl_context = None
+    if options.https:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    rate_limiter = None
+    if options.rate or options.retries:
+        rate_limiter = api.ChargifyRateLimiter(options.rate,
+            options.concurrency, options.retries, options.backoff)
+
+    metrics = options.metrics and api.ChargifyMetrics() or None
+    codec = options.format == 'json' and api.ChargifyJSONCodec() or None
+    parse_executor = None
+    if options.parse_processes:
+        parse_executor = api.ChargifyParseExecutor(options.parse_processes,
+            options.parse_threshold)
+    chargify = LoadTestChargify(host, options.https, options.concurrency,
+        ssl_context, rate_limiter, metrics, codec, parse_executor)
+    test = LoadTest(chargify, options, operations)
+    test.run()
+    chargify.session.connection_pool.clear()
+    if parse_executor is not None:
+        parse_executor.close()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    test.report(server)
+    if metrics is not None:
+        print
+        print metrics
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+''' A local stand-in for the Chargify API, to measure the client without a
+    live account. It serves the XML and JSON endpoints the client uses from
+    synthetic records, with configurable latency, injected errors and
+    payload sizes, over HTTP or HTTPS, gzip or deflate compressed for
+    clients that accept it, and counts the connections, requests and
+    response bytes it sees.
+
+    Run me from the top of the checkout:
+        python benchmarks/stubserver.py --port 8080 --latency 0.05
+'''
+
+import BaseHTTPServer
+import SocketServer
+import json
+import optparse
+import random
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+import fixtures
+
+
+USAGE = '''<?xml version="1.0" encoding="UTF-8"?>
+<usage>
+  <id>%(id)d</id>
+  <memo>%(memo)s</memo>
+  <quantity>%(quantity)s</quantity>
+</usage>
+'''
+
+_customer_subscriptions_rx = re.compile(r'^/customers/(\d+)/subscriptions\.xml$')
+_usages_rx = re.compile(r'^/subscriptions/(\d+)/components/(\d+)/usages\.xml$')
+_action_rx = re.compile(r'^/subscriptions/(\d+)/(reset_balance|reactivate)\.xml$')
+_record_rx = re.compile(r'^/(customers|products|subscriptions)/(\d+)\.xml$')
+_handle_rx = re.compile(r'^/products/handle/([^/]+)\.xml$')
+_quantity_rx = re.compile(r'<quantity>(\d+)</quantity>')
+_memo_rx = re.compile(r'<memo>([^<]*)</memo>')
+
+CONTENT_TYPES = {'xml': 'application/xml; charset=utf-8',
+    'json': 'application/json; charset=utf-8'}
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answers one keep-alive connection\'s requests from the server\'s
+        records '''
+    protocol_version = 'HTTP/1.1'
+    # Buffer responses so headers and body leave in one segment, rather
+    # than stalling on Nagle's algorithm and delayed acks
+    wbufsize = -1
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                *args)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        server = self.server
+        server.count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        data = length and self.rfile.read(length) or ''
+        server.delay()
+
+        status = server.injected_error()
+        if status is not None:
+            server.count('errors')
+            headers = {}
+            if server.retry_after is not None and status in (429, 503):
+                headers['Retry-After'] = str(server.retry_after)
+            return self._reply(status, '', headers)
+
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        content_type = CONTENT_TYPES[url.path.endswith('.json') and 'json'
+            or 'xml']
+        try:
+            body = server.route(method, url.path, query, data)
+        except (LookupError, ValueError):
+            return self._reply(404, '')
+        headers = {'Content-Type': content_type}
+        if server.compress and body:
+            body = self._compress(body, headers)
+        self._reply(method == 'POST' and 201 or 200, body, headers)
+
+    def _compress(self, body, headers):
+        accepted = [i.split(';')[0].strip() for i in
+            self.headers.get('Accept-Encoding', '').split(',')]
+        if 'gzip' in accepted:
+            encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            headers['Content-Encoding'] = 'gzip'
+        elif 'deflate' in accepted:
+            encoder = zlib.compressobj(6)
+            headers['Content-Encoding'] = 'deflate'
+        else:
+            return body
+        return encoder.compress(body) + encoder.flush()
+
+    def _reply(self, status, body, headers={}):
+        self.send_response(status)
+        if 'Content-Type' not in headers:
+            self.send_header('Content-Type', CONTENT_TYPES['xml'])
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes', len(body))
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' A threaded stub of the Chargify API. records is the number of
+        subscriptions (with a customer for every three of them and five
+        products); latency and jitter are in seconds; error_rate is the
+        fraction of requests answered with one of error_statuses instead,
+        with a Retry-After of retry_after seconds on 429 and 503; padding
+        adds that many bytes to every subscription; compress answers
+        clients that accept gzip or deflate with compressed bodies. Pass
+        certfile (and keyfile) to serve HTTPS. '''
+    daemon_threads = True
+    allow_reuse_address = True
+    # Room for every client connecting at once; a SYN dropped from a full
+    # backlog costs a second
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), records=1000, latency=0,
+        jitter=0, error_rate=0, error_statuses=(503,), retry_after=None,
+        max_per_page=200, padding=0, certfile=None, keyfile=None,
+        verbose=False, compress=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubHandler)
+        if certfile:
+            # Handshake in the connection's thread, not the accepting one
+            self.socket = ssl.wrap_socket(self.socket, keyfile, certfile,
+                server_side=True, do_handshake_on_connect=False)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.retry_after = retry_after
+        self.max_per_page = max_per_page
+        self.verbose = verbose
+        self.compress = compress
+        self.stats = {'connections': 0, 'requests': 0, 'errors': 0,
+            'bytes': 0}
+        self._stats_lock = threading.Lock()
+        self._random = random.Random()
+        self._usage_id = 0
+
+        rng = random.Random(records)
+        self.fields = [fixtures.make_fields(rng, i) for i in xrange(records)]
+        self.padding = padding
+        self.customers = {}
+        self.products = {}
+        self.handles = {}
+        self._renderers = {
+            'xml': {'subscriptions': self._subscription,
+                'customers': self._customer, 'products': self._product},
+            'json': {'subscriptions': self._subscription_json,
+                'customers': fixtures.customer_json,
+                'products': fixtures.product_json}}
+        for fields in self.fields:
+            self.customers.setdefault(fields['customer'], fields)
+            self.products.setdefault(fields['product'], fields)
+            self.handles.setdefault('plan-%d' % fields['product'], fields)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on idle keep-alive connections is business as
+        # usual
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                client_address)
+
+    def count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def injected_error(self):
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._random.choice(self.error_statuses)
+
+    def start(self):
+        ''' Serve from a daemon thread and return the port '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.port
+
+    def route(self, method, path, query, data):
+        ''' Return the response body of a request, or raise LookupError.
+            .json endpoints answer in JSON, the rest in XML. '''
+        format = 'xml'
+        if path.endswith('.json'):
+            format = 'json'
+            path = path[:-5] + '.xml'
+
+        if method == 'GET':
+            if path == '/subscriptions.xml':
+                return self._page('subscriptions', self.fields, query, format)
+            if path == '/customers.xml':
+                return self._page('customers', self._sorted(self.customers),
+                    query, format)
+            if path == '/products.xml':
+                return self._list('products', self._sorted(self.products),
+                    format)
+            if path == '/customers/lookup.xml':
+                reference = query.get('reference', '')
+                if not reference.startswith('ref-'):
+                    raise LookupError(reference)
+                return self._one('customers',
+                    self.customers[int(reference[4:])], format)
+            match = _customer_subscriptions_rx.match(path)
+            if match:
+                customer = int(match.group(1))
+                if customer not in self.customers:
+                    raise LookupError(path)
+                return self._list('subscriptions',
+                    self.fields[(customer - 1) * 3:customer * 3], format)
+            match = _handle_rx.match(path)
+            if match:
+                return self._one('products', self.handles[match.group(1)],
+                    format)
+        elif method == 'POST':
+            match = _usages_rx.match(path)
+            if match:
+                self._subscription_fields(match.group(1))
+                return self._usage(data, format)
+            if path in ('/subscriptions.xml', '/customers.xml',
+                '/products.xml'):
+                return self._saved(path[1:-4], self.fields[0], format)
+        elif method == 'PUT':
+            match = _action_rx.match(path)
+            if match:
+                return self._saved('subscriptions',
+                    self._subscription_fields(match.group(1)), format)
+
+        match = _record_rx.match(path)
+        if match and method in ('GET', 'PUT', 'DELETE'):
+            kind, id = match.groups()
+            if kind == 'subscriptions':
+                fields = self._subscription_fields(id)
+            elif kind == 'customers':
+                fields = self.customers[int(id)]
+            else:
+                fields = self.products[int(id)]
+            if method == 'GET':
+                return self._one(kind, fields, format)
+            if method == 'DELETE':
+                fields = dict(fields, state='canceled')
+            return self._saved(kind, fields, format)
+        raise LookupError(path)
+
+    def _subscription_fields(self, id):
+        id = int(id)
+        if not 0 < id <= len(self.fields):
+            raise LookupError(id)
+        return self.fields[id - 1]
+
+    def _sorted(self, records):
+        return [records[key] for key in sorted(records)]
+
+    def _subscription(self, fields):
+        record = fixtures.SUBSCRIPTION % fields
+        if self.padding:
+            record = record.replace('  </subscription>',
+                '    <notes>%s</notes>\n  </subscription>' %
+                ('x' * self.padding))
+        return record
+
+    def _customer(self, fields):
+        return fixtures.CUSTOMER % fields
+
+    def _product(self, fields):
+        return fixtures.PRODUCT % fields
+
+    def _subscription_json(self, fields):
+        record = fixtures.subscription_json(fields)
+        if self.padding:
+            record['notes'] = 'x' * self.padding
+        return record
+
+    def _one(self, kind, fields, format):
+        record = self._renderers[format][kind](fields)
+        if format == 'json':
+            return json.dumps({kind[:-1]: record})
+        return '<?xml version="1.0" encoding="UTF-8"?>\n' + record
+
+    def _list(self, kind, records, format):
+        render = self._renderers[format][kind]
+        if format == 'json':
+            return json.dumps([{kind[:-1]: render(fields)}
+                for fields in records])
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<%s type="array">\n' % kind +
+            ''.join([render(fields) for fields in records]) +
+            '</%s>\n' % kind)
+
+    def _page(self, kind, records, query, format):
+        per_page = min(int(query.get('per_page', 20)), self.max_per_page)
+        start = (int(query.get('page', 1)) - 1) * per_page
+        return self._list(kind, records[start:start + per_page], format)
+
+    def _saved(self, kind, fields, format):
+        ''' Echo a record back as saved just now '''
+        fields = dict(fields, updated=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+            time.gmtime()))
+        return self._one(kind, fields, format)
+
+    def _usage(self, data, format):
+        ''' Echo a usage back with a new id '''
+        with self._stats_lock:
+            self._usage_id += 1
+            usage_id = self._usage_id
+        if format == 'json':
+            usage = json.loads(data)['usage']
+            return json.dumps({'usage': {'id': usage_id,
+                'quantity': usage.get('quantity') or 0,
+                'memo': usage.get('memo') or ''}})
+        quantity = _quantity_rx.search(data)
+        memo = _memo_rx.search(data)
+        return USAGE % {'id': usage_id,
+            'quantity': quantity and quantity.group(1) or '0',
+            'memo': memo and memo.group(1) or ''}
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--records', type='int', default=1000,
+        help='number of subscriptions to serve')
+    parser.add_option('--latency', type='float', default=0,
+        help='seconds to wait before every response')
+    parser.add_option('--jitter', type='float', default=0,
+        help='up to that many more seconds of random latency')
+    parser.add_option('--error-rate', type='float', default=0,
+        help='fraction of requests to fail')
+    parser.add_option('--error-status', type='int', action='append',
+        dest='error_statuses', help='status of the failed requests, '
+        'may be repeated (default 503)')
+    parser.add_option('--retry-after', type='float',
+        help='Retry-After to send with 429 and 503 responses')
+    parser.add_option('--padding', type='int', default=0,
+        help='extra bytes in every subscription')
+    parser.add_option('--compress', action='store_true', default=False,
+        help='compress responses for clients that accept gzip or deflate')
+    parser.add_option('--certfile', help='serve HTTPS with this certificate')
+    parser.add_option('--keyfile')
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    server = StubServer((options.host, options.port), options.records,
+        options.latency, options.jitter, options.error_rate,
+        tuple(options.error_statuses or (503,)), options.retry_after,
+        padding=options.padding, certfile=options.certfile,
+        keyfile=options.keyfile, verbose=options.verbose,
+        compress=options.compress)
+    print "Serving %d subscriptions on %s://%s:%d" % (options.records,
+        options.certfile and 'https' or 'http', options.host, server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print server.stats
+
+
+if __name__ == "__main__":
+    main()
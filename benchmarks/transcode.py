@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+''' Benchmark fix_xml_encoding against the implementation it replaced.
+    Checks that both give byte-for-byte the same output, whole and fed
+    in chunks, also on compact XML without line breaks, and times them on
+    multi-megabyte list responses.
+
+    Run me from the top of the checkout: python benchmarks/transcode.py
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import api
+from fixtures import make_response
+
+
+def legacy_fix_xml_encoding(xml):
+    ''' fix_xml_encoding as it was before the single pass transcoder. '''
+    return unicode(''.join([i.strip() for i in xml.split('\n')])).encode(
+        'CP1252', 'replace').decode('utf-8', 'ignore').encode(
+        'ascii', 'xmlcharrefreplace')
+
+
+def transcode_chunks(xml, chunk_size):
+    ''' Run xml through the incremental transcoder chunk by chunk. '''
+    transcoder = api.ChargifyTranscoder()
+    out = [transcoder.feed(xml[i:i + chunk_size])
+        for i in xrange(0, len(xml), chunk_size)]
+    out.append(transcoder.close())
+    return ''.join(out)
+
+
+def check_equivalence(xml):
+    ''' Compare the output of both implementations, on the document and
+        on compact versions of it without line breaks. '''
+    for document in (xml, xml.replace('\n', ''), xml.replace('\n', ' ')):
+        expected = legacy_fix_xml_encoding(document)
+        assert api.ChargifyTranscoder.transcode(document) == expected
+        for chunk_size in (1, 7, 4096, 65536):
+            if chunk_size == 1 and len(document) > 100000:
+                continue
+            assert transcode_chunks(document, chunk_size) == expected
+
+    # A line doesn't have to end before its start is output
+    transcoder = api.ChargifyTranscoder()
+    compact = xml.replace('\n', '')
+    assert transcoder.feed(compact[:len(compact) // 2])
+
+
+def run_benchmark(repeat=5):
+    ''' Check and time both implementations on a few response sizes. '''
+    # CP1252 mangled UTF-8, the case fix_xml_encoding exists for
+    check_equivalence(make_response(50, 'J\xc3\xb6rg').decode('CP1252'))
+
+    for count in (1000, 5000, 20000):
+        xml = make_response(count, 'John')
+        check_equivalence(xml)
+
+        legacy = min(timeit.repeat(lambda: legacy_fix_xml_encoding(xml),
+            number=1, repeat=repeat))
+        single = min(timeit.repeat(
+            lambda: api.ChargifyTranscoder.transcode(xml),
+            number=1, repeat=repeat))
+        chunked = min(timeit.repeat(lambda: transcode_chunks(xml, 65536),
+            number=1, repeat=repeat))
+        compact = xml.replace('\n', '')
+        compact_chunked = min(timeit.repeat(
+            lambda: transcode_chunks(compact, 65536), number=1,
+            repeat=repeat))
+        print "%6d subscriptions, %5.1f MB: legacy %7.1f ms, " \
+            "single pass %7.1f ms (%.1fx), chunked %7.1f ms, " \
+            "compact chunked %7.1f ms" % (count, len(xml) / 1048576.0,
+            legacy * 1000, single * 1000, legacy / single, chunked * 1000,
+            compact_chunked * 1000)
+
+
+if __name__ == "__main__":
+    run_benchmark()
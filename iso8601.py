@@ -11,12 +11,17 @@ This module was written by Fred L. Drake, Jr. <fdrake@acm.org>.
 
 __version__ = '1.0'
 
+import calendar
+import datetime
 import time
 
 
 def parse(s):
     """Parse an ISO-8601 date/time string, returning the value in seconds
     since the epoch."""
+    fields = __parse_fixed(s)
+    if fields is not None:
+        return float(calendar.timegm(fields[:6]) + fields[6])
     m = __datetime_rx.match(s)
     if m is None or m.group() != s:
         raise ValueError, "unknown or illegal ISO-8601 date format: " + `s`
@@ -24,6 +29,67 @@ def parse(s):
     return time.mktime(gmt) + __extract_tzd(m) - time.timezone
 
 
+def parse_datetime(s):
+    """Parse an ISO-8601 date/time string, returning a timezone-aware
+    datetime in the time zone given in the string (UTC if there is none)."""
+    fields = __parse_fixed(s)
+    if fields is None:
+        m = __datetime_rx.match(s)
+        if m is None or m.group() != s:
+            raise ValueError, "unknown or illegal ISO-8601 date format: " + `s`
+        return datetime.datetime.fromtimestamp(parse(s),
+            FixedOffset(__extract_tzd(m)))
+    year, month, day, hours, minutes, seconds, tzd, tzinfo = fields
+    if seconds == 60:
+        # A leap second; datetime stops at 59
+        return datetime.datetime(year, month, day, hours, minutes, 59,
+            0, tzinfo) + datetime.timedelta(seconds=1)
+    return datetime.datetime(year, month, day, hours, minutes, seconds,
+        0, tzinfo)
+
+
+def parse_many(strings):
+    """Parse a sequence of ISO-8601 date/time strings, returning a list of
+    timezone-aware datetimes (see parse_datetime()).  Repeated strings are
+    only decoded once."""
+    decoded = {}
+    result = []
+    for s in strings:
+        try:
+            result.append(decoded[s])
+        except KeyError:
+            value = decoded[s] = parse_datetime(s)
+            result.append(value)
+    return result
+
+
+class FixedOffset(datetime.tzinfo):
+    """A fixed offset time zone, as found in ISO-8601 strings.  The offset
+    is given in seconds relative to UTC with the sign used by
+    parse_timezone(), so "-05:00" is 18000."""
+
+    def __init__(self, tzd):
+        self.__offset = datetime.timedelta(seconds=-tzd)
+        if tzd:
+            sign = (tzd < 0) and "+" or "-"
+            self.__name = "%c%02d:%02d" % (sign, abs(tzd) / 3600,
+                abs(tzd) % 3600 / 60)
+        else:
+            self.__name = "UTC"
+
+    def utcoffset(self, dt):
+        return self.__offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return self.__name
+
+    def __repr__(self):
+        return "<FixedOffset %s>" % self.__name
+
+
 def parse_timezone(timezone):
     """Parse an ISO-8601 time zone designator, returning the value in seconds
     relative to UTC."""
@@ -95,8 +161,44 @@ __time_re = ("(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)"
 __datetime_re = "%s(?:T%s)?" % (__date_re, __time_re)
 __datetime_rx = re.compile(__datetime_re)
 
+# The fixed YYYY-MM-DDTHH:MM:SS+HH:MM form Chargify sends, which parse()
+# and parse_datetime() decode without going through the regex above.
+__fixed_rx = re.compile(r"(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)"
+                        r"(Z|[-+]\d\d:\d\d)\Z")
+
 del re
 
+# Time zone designator -> (offset in seconds, FixedOffset)
+__tzd_cache = {}
+
+
+def __parse_fixed(s):
+    """Return (year, month, day, hours, minutes, seconds, tzd, tzinfo) for a
+    string in the fixed format, or None for anything else."""
+    m = __fixed_rx.match(s)
+    if m is None:
+        return None
+    year, month, day, hours, minutes, seconds, tzd = m.groups()
+    month = int(month)
+    day = int(day)
+    hours = int(hours)
+    minutes = int(minutes)
+    seconds = int(seconds)
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hours <= 23
+            and minutes <= 59 and seconds <= 60):
+        # Let the general parser report what is wrong
+        return None
+    year = int(year)
+    if day > calendar.monthrange(year, month)[1]:
+        raise ValueError, "illegal day number: %02d" % day
+    try:
+        offset, tzinfo = __tzd_cache[tzd]
+    except KeyError:
+        offset = parse_timezone(tzd)
+        tzinfo = FixedOffset(offset)
+        __tzd_cache[tzd] = (offset, tzinfo)
+    return year, month, day, hours, minutes, seconds, offset, tzinfo
+
 
 def __extract_date(m):
     year = int(m.group("year"))
@@ -115,7 +217,7 @@ def __extract_date(m):
             day = m.group("day")
             if day:
                 day = int(day)
-                if not 1 <= day <= 31:
+                if not 1 <= day <= calendar.monthrange(year, month)[1]:
                     raise ValueError, "illegal day number: " + m.group("day")
             else:
                 day = 1
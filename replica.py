@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+A local SQLite replica of a Chargify account's products, customers and
+subscriptions, kept up to date incrementally, for reporting and support
+tools that would otherwise list the whole account over and over.
+'''
+
+import datetime
+import sqlite3
+import threading
+import time
+
+import api
+import iso8601
+from api import json
+
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY,
+    handle TEXT,
+    updated_at REAL,
+    record TEXT NOT NULL
+);
+CREATE INDEX products_handle ON products (handle);
+
+CREATE TABLE customers (
+    id INTEGER PRIMARY KEY,
+    reference TEXT,
+    updated_at REAL,
+    record TEXT NOT NULL
+);
+CREATE INDEX customers_reference ON customers (reference);
+
+CREATE TABLE subscriptions (
+    id INTEGER PRIMARY KEY,
+    state TEXT,
+    customer_id INTEGER,
+    product_id INTEGER,
+    current_period_ends_at REAL,
+    updated_at REAL,
+    record TEXT NOT NULL
+);
+CREATE INDEX subscriptions_state ON subscriptions (state);
+CREATE INDEX subscriptions_customer ON subscriptions (customer_id);
+CREATE INDEX subscriptions_product ON subscriptions (product_id);
+CREATE INDEX subscriptions_period_end
+    ON subscriptions (current_period_ends_at);
+
+CREATE TABLE sync_state (
+    name TEXT PRIMARY KEY,
+    updated_at REAL
+);
+'''
+
+# Table -> its columns after id and before updated_at and record
+COLUMNS = {
+    'products': ('handle',),
+    'customers': ('reference',),
+    'subscriptions': ('state', 'customer_id', 'product_id',
+        'current_period_ends_at'),
+}
+
+# Nested objects kept in tables of their own rather than in the record
+_LINKED = frozenset(['customer', 'product'])
+
+
+def _epoch(value):
+    """
+    Return a datetime as seconds since the epoch, anything else as None
+    """
+    if isinstance(value, datetime.datetime):
+        return api._timestamp(value)
+    return None
+
+
+def _record(obj, skip=()):
+    """
+    Return the fields of an object as a dict that encodes to the JSON the
+    JSON codec reads back into an equal object
+    """
+    fields = {}
+    for name, value in obj._get_fields():
+        if name in skip or name.startswith('_'):
+            continue
+        if isinstance(value, api.ChargifyBase):
+            value = _record(value)
+        elif isinstance(value, datetime.datetime):
+            value = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                time.gmtime(_epoch(value)))
+        fields[name] = value
+    return fields
+
+
+def _id(obj):
+    try:
+        return int(obj.id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ChargifyReplica(object):
+    """
+    Mirrors the products, customers and subscriptions of an account into
+    an SQLite database. sync() pulls what changed since the last sync,
+    going by updated_at; refresh() and apply_postback() update single
+    subscriptions, e.g. the ones a postback names. The query methods only
+    read the database and never touch the network; the objects they
+    return belong to the client's session, so they can be saved as usual.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, chargify, path=':memory:', per_page=200, overlap=60):
+        """
+        chargify is the Chargify client to sync from and path the database
+        file. Lists are pulled per_page records at a time, and every sync
+        starts overlap seconds before the newest updated_at seen so far, so
+        changes made while the last one ran aren't missed.
+        """
+        self.session = chargify.session
+        self.path = path
+        self.per_page = per_page
+        self.overlap = overlap
+        self._base = api.ChargifySubscription(session=self.session)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version == SCHEMA_VERSION:
+                return
+            # A replica of another layout is rebuilt from scratch
+            with self._db:
+                for name in COLUMNS.keys() + ['sync_state']:
+                    self._db.execute('DROP TABLE IF EXISTS %s' % name)
+            self._db.executescript(SCHEMA)
+            self._db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def sync(self):
+        """
+        Pull every product and the customers and subscriptions updated
+        since the last sync, and return how many of each were stored
+        """
+        counts = {}
+        products = api.ChargifyProduct(session=self.session).getAll()
+        counts['products'] = self._store('products', products)
+        counts['customers'] = self._pull('customers',
+            api.ChargifyCustomer(session=self.session).iterAll(
+                self.per_page, since=self._since('customers')))
+        counts['subscriptions'] = self._pull('subscriptions',
+            self._base.iterAll(self.per_page, since=self._since(
+                'subscriptions'), identity_map=api.ChargifyIdentityMap()))
+        return counts
+
+    def refresh(self, subscription_ids, concurrency=10):
+        """
+        Fetch the subscriptions with the given ids and apply them as a
+        postback would, see apply_postback()
+        """
+        postback = api.ChargifyPostBack(self.session.api_key,
+            self.session.sub_domain, json.dumps(list(subscription_ids)),
+            concurrency, self.session)
+        return self.apply_postback(postback)
+
+    def apply_postback(self, postback):
+        """
+        Store the subscriptions a ChargifyPostBack fetched and drop the
+        ones it found gone. Returns the counts of refreshed, removed and
+        failed ids.
+        """
+        removed = [id for id, error in postback.failures
+            if isinstance(error, api.ChargifyNotFound)]
+        self._store('subscriptions', postback.subscriptions)
+        if removed:
+            with self._lock:
+                with self._db:
+                    self._db.executemany(
+                        'DELETE FROM subscriptions WHERE id = ?',
+                        [(int(id),) for id in removed])
+        return {'refreshed': len(postback.subscriptions),
+            'removed': len(removed),
+            'failed': len(postback.failures) - len(removed)}
+
+    def _since(self, name):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT updated_at FROM sync_state WHERE name = ?',
+                (name,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.datetime.fromtimestamp(row[0] - self.overlap,
+            iso8601.FixedOffset(0))
+
+    def _pull(self, name, objs):
+        """
+        Store the objects of a list call a page at a time, then move the
+        table's high-water mark up to the newest updated_at among them
+        """
+        stored = 0
+        newest = None
+        page = []
+        for obj in objs:
+            page.append(obj)
+            newest = max(newest, _epoch(getattr(obj, 'updated_at', None)))
+            if len(page) >= self.per_page:
+                stored += self._store(name, page)
+                page = []
+        if page:
+            stored += self._store(name, page)
+        if newest is not None:
+            with self._lock:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO sync_state '
+                        '(name, updated_at) SELECT ?, ? WHERE NOT EXISTS '
+                        '(SELECT 1 FROM sync_state WHERE name = ? AND '
+                        'updated_at >= ?)', (name, newest, name, newest))
+        return stored
+
+    def _store(self, name, objs):
+        """
+        Write objects to a table, with the customers and products nested
+        in subscriptions going to theirs. A row is only replaced by one
+        that is at least as recent, and a nested copy without an
+        updated_at only fills in a row that is missing.
+        """
+        # (table, only if missing) -> rows
+        rows = {}
+        stored = 0
+        for obj in objs:
+            id = _id(obj)
+            if id is None:
+                continue
+            stored += 1
+            if name != 'subscriptions':
+                rows.setdefault((name, False), []).append(
+                    self._row(name, obj))
+                continue
+            customer = getattr(obj, 'customer', None)
+            product = getattr(obj, 'product', None)
+            for table, nested in (('customers', customer),
+                ('products', product)):
+                if isinstance(nested, api.ChargifyBase) and \
+                    _id(nested) is not None:
+                    row = self._row(table, nested)
+                    rows.setdefault((table, row[-2] is None), []).append(row)
+            rows.setdefault((name, False), []).append((id,
+                getattr(obj, 'state', None), _id(customer), _id(product),
+                _epoch(getattr(obj, 'current_period_ends_at', None)),
+                _epoch(getattr(obj, 'updated_at', None)),
+                json.dumps(_record(obj, _LINKED), default=unicode)))
+
+        with self._lock:
+            with self._db:
+                for (table, if_missing), table_rows in rows.iteritems():
+                    columns = ('id',) + COLUMNS[table] + ('updated_at',
+                        'record')
+                    values = ', '.join(['?'] * len(columns))
+                    if if_missing:
+                        self._db.executemany('INSERT OR IGNORE INTO %s '
+                            '(%s) VALUES (%s)' % (table, ', '.join(columns),
+                            values), table_rows)
+                        continue
+                    self._db.executemany('INSERT OR REPLACE INTO %s (%s) '
+                        'SELECT %s WHERE NOT EXISTS (SELECT 1 FROM %s '
+                        'WHERE id = ? AND updated_at > ?)' % (table,
+                        ', '.join(columns), values, table),
+                        [row + (row[0], row[-2]) for row in table_rows])
+        return stored
+
+    def _row(self, table, obj):
+        column, = COLUMNS[table]
+        return (_id(obj), getattr(obj, column, None),
+            _epoch(getattr(obj, 'updated_at', None)),
+            json.dumps(_record(obj), default=unicode))
+
+    def _load(self, obj_type, node_name, records):
+        """
+        Turn stored records back into objects, sharing nested ones
+        """
+        parser = api.ChargifyJSONParser(self._base, obj_type, node_name,
+            identity_map=api.ChargifyIdentityMap())
+        parser.feed('[%s]' % ','.join(['{"%s": %s}' % (node_name, record)
+            for record in records]))
+        return parser.close()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _one(self, objs):
+        if objs:
+            return objs[0]
+
+    def subscriptions(self, state=None, customer_id=None, product_id=None,
+        ends_after=None, ends_before=None):
+        """
+        Return the stored subscriptions, optionally only those in a state,
+        of a customer, of a product or whose current period ends at or
+        after ends_after and before ends_before (datetimes)
+        """
+        where = []
+        args = []
+        if state is not None:
+            where.append('s.state = ?')
+            args.append(state)
+        for column, value in (('customer_id', customer_id),
+            ('product_id', product_id)):
+            if value is not None:
+                where.append('s.%s = ?' % column)
+                args.append(int(value))
+        if ends_after is not None:
+            where.append('s.current_period_ends_at >= ?')
+            args.append(_epoch(ends_after))
+        if ends_before is not None:
+            where.append('s.current_period_ends_at < ?')
+            args.append(_epoch(ends_before))
+        return self._subscriptions(where, args)
+
+    def subscription(self, id):
+        return self._one(self._subscriptions(['s.id = ?'], [int(id)]))
+
+    def _subscriptions(self, where, args):
+        sql = 'SELECT s.record, c.record, p.record FROM subscriptions s ' \
+            'LEFT JOIN customers c ON c.id = s.customer_id ' \
+            'LEFT JOIN products p ON p.id = s.product_id'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        records = []
+        for record, customer, product in self._query(sql + ' ORDER BY s.id',
+            args):
+            # Splice the customer and product back into the record
+            nested = ''
+            if customer is not None:
+                nested += ', "customer": ' + customer
+            if product is not None:
+                nested += ', "product": ' + product
+            records.append(record[:-1] + nested + '}')
+        return self._load('ChargifySubscription', 'subscription', records)
+
+    def customers(self):
+        return self._load('ChargifyCustomer', 'customer', [r for r, in
+            self._query('SELECT record FROM customers ORDER BY id')])
+
+    def customer(self, id):
+        return self._one(self._load('ChargifyCustomer', 'customer',
+            [r for r, in self._query(
+                'SELECT record FROM customers WHERE id = ?', (int(id),))]))
+
+    def customer_by_reference(self, reference):
+        return self._one(self._load('ChargifyCustomer', 'customer',
+            [r for r, in self._query('SELECT record FROM customers '
+                'WHERE reference = ? ORDER BY id', (reference,))]))
+
+    def products(self):
+        return self._load('ChargifyProduct', 'product', [r for r, in
+            self._query('SELECT record FROM products ORDER BY id')])
+
+    def product(self, id):
+        return self._one(self._load('ChargifyProduct', 'product',
+            [r for r, in self._query(
+                'SELECT record FROM products WHERE id = ?', (int(id),))]))
+
+    def product_by_handle(self, handle):
+        return self._one(self._load('ChargifyProduct', 'product',
+            [r for r, in self._query('SELECT record FROM products '
+                'WHERE handle = ? ORDER BY id', (handle,))]))
+
+    def stats(self):
+        """
+        Return the number of stored records per table and when the
+        newest record pulled by sync() was updated
+        """
+        stats = {}
+        for table in COLUMNS:
+            stats[table], = self._query('SELECT COUNT(*) FROM %s' %
+                table)[0]
+        for name, updated_at in self._query(
+            'SELECT name, updated_at FROM sync_state'):
+            stats[name + '_updated_at'] = datetime.datetime.fromtimestamp(
+                updated_at, iso8601.FixedOffset(0))
+        return stats
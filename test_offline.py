@@ -0,0 +1,1139 @@
+#!/usr/bin/env python
+''' Offline tests of the Pychargify Library: no account or network needed,
+    unlike tests.py.
+
+    Run me from the top of the checkout: python -m unittest test_offline
+'''
+
+import calendar
+import copy
+import cPickle
+import datetime
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from email.utils import formatdate
+from xml.dom import minidom
+
+import api
+import iso8601
+import replica
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'benchmarks'))
+from stubserver import StubHandler, StubServer
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'benchmarks', 'data')
+
+# The corners of XML the lazy scanner has to decode like the parser
+EDGE_CASES = '''<?xml version="1.0" encoding="UTF-8"?>
+<subscriptions type="array">
+  <subscription>
+    <id>1</id>
+    <state>active &amp; &lt;paid&gt; &#233;t&#xE9; &quot;ok&quot;</state>
+    <memo><![CDATA[<b>ignored</b>]]>kept</memo>
+    <notes>before<b>inside</b>after</notes>
+    <cancellation_message/>
+    <balance_in_cents type="integer">0</balance_in_cents>
+    <created_at type="datetime">2010-02-24T18:15:29-05:00</created_at>
+    <expires_at type="datetime"></expires_at>
+    <customer>
+      <id>7</id>
+      <first_name>J&#246;rg</first_name>
+      <organization/>
+    </customer>
+    <product><id>3</id><handle>plan-3</handle></product>
+    <credit_card/>
+  </subscription>
+  <subscription>
+    <id>2</id>
+    <state>past_due</state>
+    <customer><id>7</id><first_name>J&#246;rg</first_name></customer>
+    <product>
+      <id>3</id>
+      <handle>plan-3</handle>
+    </product>
+  </subscription>
+  <subscription/>
+</subscriptions>
+'''
+
+
+def _session(codec=None):
+    return api.ChargifySession('offline', 'offline', codec=codec)
+
+
+def _fields(obj):
+    ''' The fields of a model object as a dict, nested objects as dicts of
+        their own, for comparing objects built in different ways '''
+    fields = {}
+    for name, value in obj._get_fields():
+        if isinstance(value, api.ChargifyBase):
+            value = _fields(value)
+        fields[name] = value
+    return fields
+
+
+def _parse(body, codec=None, **kwargs):
+    base = api.ChargifySubscription(session=_session(codec))
+    return base._parse(body, 'ChargifySubscription', 'subscription',
+        **kwargs)
+
+
+def _minidom_records(xml, node_name, attribute_types):
+    ''' The fields of the node_name records of a document, mapped the way
+        the library did with minidom before the streaming parser, to pin
+        the parsers to it '''
+    dom = minidom.parseString(api.ChargifyTranscoder.transcode(xml))
+    return [_minidom_fields(node, attribute_types)
+        for node in dom.getElementsByTagName(node_name)]
+
+
+def _minidom_toxml(obj):
+    ''' Serialize an object the way the library did with minidom before
+        the string serializer, fields in the order the serializer takes
+        them, to pin the serializer to it '''
+    dom = minidom.Document()
+    dom.appendChild(_minidom_element(dom, obj))
+    return dom.toxml(encoding='utf-8')
+
+
+def _minidom_element(dom, obj):
+    element = dom.createElement(obj.__xmlnodename__)
+    for name, value in obj._get_fields():
+        if name in obj.__ignore__:
+            continue
+        if name in obj.__attribute_types__:
+            element.appendChild(_minidom_element(dom, value))
+            continue
+        node = dom.createElement(name)
+        if not isinstance(value, unicode):
+            value = str(value)
+        node.appendChild(dom.createTextNode(value))
+        element.appendChild(node)
+    return element
+
+
+def _minidom_fields(node, attribute_types):
+    fields = {}
+    for child in node.childNodes:
+        if child.nodeType != child.ELEMENT_NODE:
+            continue
+        if child.nodeName in attribute_types:
+            fields[child.nodeName] = _minidom_fields(child, attribute_types)
+            continue
+        value = ''.join([text.data for text in child.childNodes
+            if text.nodeType == text.TEXT_NODE])
+        if value and child.getAttribute('type') == 'datetime':
+            value = datetime.datetime.fromtimestamp(iso8601.parse(value))
+        fields[child.nodeName] = value
+    return fields
+
+
+def _start(server):
+    ''' Serve from a stub server and return a session talking to it '''
+    host = '127.0.0.1:%d' % server.start()
+    return api.ChargifySession('offline', 'offline', host,
+        api.ChargifyConnectionPool(secure=False))
+
+
+def _stop(server, session):
+    session.connection_pool.clear()
+    server.shutdown()
+    server.server_close()
+
+
+class PagingServer(StubServer):
+    ''' A stub server whose list pages can be slowed down or failed, and
+        which counts the most pages it served at once '''
+
+    def __init__(self, *args, **kwargs):
+        StubServer.__init__(self, *args, **kwargs)
+        self.slow_pages = {}
+        self.failing_pages = set()
+        self.queries = []
+        self.busy = self.max_busy = 0
+        self._busy_lock = threading.Lock()
+
+    def route(self, method, path, query, data):
+        self.queries.append((path, query))
+        page = int(query.get('page', 0))
+        with self._busy_lock:
+            self.busy += 1
+            self.max_busy = max(self.max_busy, self.busy)
+        try:
+            time.sleep(self.slow_pages.get(page, 0.01))
+            if page in self.failing_pages:
+                raise LookupError(page)
+            return StubServer.route(self, method, path, query, data)
+        finally:
+            with self._busy_lock:
+                self.busy -= 1
+
+
+class ScriptedServer(StubServer):
+    ''' A stub server that answers with the error statuses in statuses,
+        one per request, before it goes back to answering normally '''
+
+    def __init__(self, *args, **kwargs):
+        StubServer.__init__(self, *args, **kwargs)
+        self.statuses = []
+
+    def injected_error(self):
+        if self.statuses:
+            return self.statuses.pop(0)
+
+
+class ValidatingHandler(StubHandler):
+    ''' Sends an ETag with every GET response and answers 304 Not
+        Modified when the client already has it '''
+
+    def _reply(self, status, body, headers={}):
+        if self.command == 'GET' and status == 200 and \
+            self.server.validators:
+            etag = '"%x"' % (hash(body) & 0xffffffff)
+            headers = dict(headers, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                self.server.count('not_modified')
+                status, body = 304, ''
+        StubHandler._reply(self, status, body, headers)
+
+
+class ValidatingServer(StubServer):
+    ''' A stub server whose GET responses carry validators, unless
+        validators is turned off '''
+
+    def __init__(self, *args, **kwargs):
+        StubServer.__init__(self, *args, **kwargs)
+        self.RequestHandlerClass = ValidatingHandler
+        self.validators = True
+        self.stats['not_modified'] = 0
+
+
+class RawDeflateHandler(StubHandler):
+    ''' Sends deflate bodies without the zlib wrapper, as some servers do '''
+
+    def _compress(self, body, headers):
+        encoder = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        headers['Content-Encoding'] = 'deflate'
+        return encoder.compress(body) + encoder.flush()
+
+
+def _set_time_zone(zone):
+    ''' Make zone the local time zone (None for the system's) and return
+        the one it replaces '''
+    previous = os.environ.get('TZ')
+    if zone is None:
+        os.environ.pop('TZ', None)
+    else:
+        os.environ['TZ'] = zone
+    time.tzset()
+    return previous
+
+
+def _data(name):
+    f = open(os.path.join(DATA, name), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class CopyTest(unittest.TestCase):
+    ''' Copies of model objects stay in their session '''
+
+    def setUp(self):
+        self.session = _session()
+        self.subscription = api.ChargifySubscription(session=self.session)
+        self.subscription.id = '1'
+        self.subscription.state = 'active'
+        self.subscription.customer = api.ChargifyCustomer(
+            session=self.session)
+        self.subscription.customer.first_name = 'John'
+
+    def test_copy(self):
+        subscription = copy.copy(self.subscription)
+        self.assertTrue(subscription.session is self.session)
+        self.assertEqual(subscription.api_key, 'offline')
+        self.assertEqual(subscription.request_host, 'offline.chargify.com')
+        self.assertEqual(subscription.state, 'active')
+        self.assertTrue(subscription.customer is self.subscription.customer)
+
+    def test_deepcopy(self):
+        subscription = copy.deepcopy(self.subscription)
+        self.assertTrue(subscription.session is self.session)
+        self.assertTrue(subscription.customer.session is self.session)
+        self.assertEqual(subscription.api_key, 'offline')
+        self.assertEqual(subscription.id, '1')
+        self.assertEqual(subscription.state, 'active')
+        self.assertFalse(subscription.customer is
+            self.subscription.customer)
+        self.assertEqual(subscription.customer.first_name, 'John')
+        self.assertEqual(subscription.customer.api_key, 'offline')
+
+    def test_pickle(self):
+        self.session.request_host = 'localhost:8000'
+        session = api.ChargifySession.get('offline', 'offline',
+            'localhost:8000')
+        for module in (pickle, cPickle):
+            for protocol in (0, 2):
+                subscription = module.loads(module.dumps(self.subscription,
+                    protocol))
+                self.assertTrue(subscription.session is session)
+                self.assertTrue(subscription.customer.session is session)
+                self.assertEqual(subscription.id, '1')
+                self.assertEqual(subscription.state, 'active')
+                self.assertEqual(subscription.customer.first_name, 'John')
+
+    def test_pickle_default_host(self):
+        subscription = cPickle.loads(cPickle.dumps(self.subscription, 2))
+        self.assertTrue(subscription.session is
+            api.ChargifySession.get('offline', 'offline'))
+        self.assertEqual(subscription.request_host, 'offline.chargify.com')
+
+
+class CatalogTest(unittest.TestCase):
+    ''' Concurrent misses fill the product catalog once '''
+
+    def setUp(self):
+        self.session = _session()
+        self.products = []
+        for i in xrange(1, 6):
+            product = api.ChargifyProduct(session=self.session)
+            product.id = str(i)
+            product.handle = 'plan-%d' % i
+            self.products.append(product)
+        self.catalog = api.ChargifyProductCatalog()
+        self.loads = []
+
+    def load_all(self):
+        self.loads.append('all')
+        time.sleep(0.05)
+        self.catalog.fill(self.products)
+
+    def load_stored(self):
+        self.loads.append('stored')
+        time.sleep(0.05)
+        return (self.products, False)
+
+    def load_one(self):
+        self.loads.append('one')
+
+    def _misses(self, load_stored=None):
+        found = []
+
+        def miss(i):
+            found.append(self.catalog.get('handle', 'plan-%d' % (i % 5 + 1),
+                self.load_all, self.load_one, load_stored))
+        threads = [threading.Thread(target=miss, args=(i,))
+            for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return found
+
+    def test_single_fill(self):
+        found = self._misses()
+        self.assertEqual(self.loads, ['all'])
+        self.assertEqual(len(found), 10)
+        self.assertTrue(None not in found)
+
+    def test_single_warm(self):
+        found = self._misses(self.load_stored)
+        self.assertEqual(self.loads, ['stored'])
+        self.assertTrue(None not in found)
+
+
+# Dates in the fixed format parse() and parse_datetime() take a shortcut
+# for, across zones, leap days, a leap second and a DST change
+DATES = ('2010-02-24T18:15:29-05:00', '2010-02-24T23:15:29Z',
+    '2010-03-14T02:30:00-05:00', '2010-11-07T01:30:00-04:00',
+    '2012-02-29T12:00:00+09:00', '1999-12-31T23:59:59-03:30',
+    '2000-01-01T05:29:59+05:45', '2008-12-31T23:59:60Z')
+
+# Dates no parser must accept
+BAD_DATES = ('2010-02-30T00:00:00Z', '2011-02-29T00:00:00+01:00',
+    '2010-04-31T12:00:00-05:00', '2010-02-30T00:00:00.0Z',
+    '2010-02-24T18:15:29Z\n', '2010-02-24T18:15:29-05:00\n')
+
+
+def _fractional(date):
+    ''' The same date with fractional seconds, which go through the
+        regex '''
+    return date[:19] + '.0' + date[19:]
+
+
+class Iso8601Test(unittest.TestCase):
+    ''' The fixed format shortcut decodes dates like the general parser '''
+
+    def test_fast_path(self):
+        zone = None
+        try:
+            for zone in ('UTC', 'America/New_York', 'Asia/Tokyo',
+                'Australia/Adelaide'):
+                previous = _set_time_zone(zone)
+                for date in DATES:
+                    seconds = iso8601.parse(date)
+                    self.assertEqual(seconds, iso8601.parse(_fractional(date)))
+                    value = iso8601.parse_datetime(date)
+                    regex_value = iso8601.parse_datetime(_fractional(date))
+                    self.assertEqual(value, regex_value)
+                    self.assertEqual(value.utcoffset(),
+                        regex_value.utcoffset())
+                    self.assertEqual(value.tzname(), regex_value.tzname())
+                    self.assertEqual(calendar.timegm(value.utctimetuple()),
+                        seconds)
+        finally:
+            if zone is not None:
+                _set_time_zone(previous)
+
+    def test_parse_datetime(self):
+        value = iso8601.parse_datetime('2010-02-24T18:15:29-05:00')
+        self.assertEqual(value.timetuple()[:6], (2010, 2, 24, 18, 15, 29))
+        self.assertEqual(value.utcoffset(), datetime.timedelta(hours=-5))
+        self.assertEqual(value.tzname(), '-05:00')
+        self.assertEqual(value, iso8601.parse_datetime('2010-02-24T23:15:29Z'))
+        self.assertEqual(iso8601.parse_datetime('2008-12-31T23:59:60Z'),
+            iso8601.parse_datetime('2009-01-01T00:00:00Z'))
+
+    def test_parse_many(self):
+        dates = list(DATES) + list(DATES[:3])
+        values = iso8601.parse_many(dates)
+        self.assertEqual(values, [iso8601.parse_datetime(date)
+            for date in dates])
+        for i in xrange(3):
+            self.assertTrue(values[len(DATES) + i] is values[i])
+
+    def test_fixed_offset(self):
+        for tzd, name, offset in ((0, 'UTC', 0), (18000, '-05:00', -300),
+            (-19800, '+05:30', 330), (12600, '-03:30', -210)):
+            tzinfo = iso8601.FixedOffset(tzd)
+            self.assertEqual(tzinfo.tzname(None), name)
+            self.assertEqual(tzinfo.utcoffset(None),
+                datetime.timedelta(minutes=offset))
+            self.assertEqual(tzinfo.dst(None), datetime.timedelta(0))
+            self.assertEqual(repr(tzinfo), '<FixedOffset %s>' % name)
+
+    def test_bad_dates(self):
+        for date in BAD_DATES:
+            self.assertRaises(ValueError, iso8601.parse, date)
+            self.assertRaises(ValueError, iso8601.parse_datetime, date)
+            self.assertRaises(ValueError, iso8601.parse_many, [date])
+
+
+class EvictingCache(api.ChargifyResponseCache):
+    ''' A response cache that loses everything right after handing out
+        the validators, as if evicted by another thread '''
+
+    def get_headers(self, host, url, lazy=False):
+        headers = api.ChargifyResponseCache.get_headers(self, host, url, lazy)
+        self.clear()
+        return headers
+
+
+class ResponseCacheTest(unittest.TestCase):
+    ''' Cached responses are revalidated and reused, and counted once '''
+
+    def setUp(self):
+        self.server = ValidatingServer(records=30)
+        self.session = _start(self.server)
+        self.cache = self.session.response_cache = \
+            api.ChargifyResponseCache([r'/customers'])
+        self.customer = api.ChargifyCustomer(session=self.session)
+
+    def tearDown(self):
+        _stop(self.server, self.session)
+
+    def _counts(self):
+        stats = self.cache.stats()
+        return (stats['hits'], stats['misses'],
+            self.server.stats['not_modified'])
+
+    def test_not_modified(self):
+        customers = self.customer.getAll()
+        self.assertEqual(len(customers), 10)
+        self.assertEqual(self._counts(), (0, 1, 0))
+        again = self.customer.getAll()
+        self.assertEqual(self._counts(), (1, 1, 1))
+        self.assertEqual(len(again), 10)
+        for customer, cached in zip(customers, again):
+            self.assertTrue(cached is customer)
+
+    def test_lazy(self):
+        customers = self.customer.getAll()
+        lazy = self.customer.getAll(lazy=True)
+        # A different entry, fetched in full
+        self.assertEqual(self._counts(), (0, 2, 0))
+        self.assertEqual(self.cache.stats()['entries'], 2)
+        self.assertTrue(lazy[0] is not customers[0])
+        self.assertTrue(lazy[0]._raw is not None)
+        self.assertEqual(getattr(customers[0], '_raw', None), None)
+        for cached, customer in zip(self.customer.getAll(lazy=True), lazy):
+            self.assertTrue(cached is customer)
+        for cached, customer in zip(self.customer.getAll(), customers):
+            self.assertTrue(cached is customer)
+        self.assertEqual(self._counts(), (2, 2, 2))
+        self.assertEqual(_fields(lazy[0]), _fields(customers[0]))
+
+    def test_evicted(self):
+        cache = self.session.response_cache = EvictingCache([r'/customers'])
+        self.customer.getAll()
+        self.assertEqual(len(self.customer.getAll()), 10)
+        stats = cache.stats()
+        # The 304 for the evicted entry and the refetch are one miss
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+        self.assertEqual(self.server.stats['requests'], 3)
+        self.assertEqual(self.server.stats['not_modified'], 1)
+
+    def test_sizeof(self):
+        self.cache.max_size = 2
+        self.cache.sizeof = len
+        for id in (1, 2, 3):
+            self.customer.getById(id)
+        # 1 was evicted; 2 is used again, so 3 goes next
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.customer.getById(2)
+        self.assertEqual(self._counts(), (1, 3, 1))
+        self.customer.getById(1)
+        self.assertEqual(self._counts(), (1, 4, 1))
+        self.customer.getById(2)
+        self.customer.getById(3)
+        self.assertEqual(self._counts(), (2, 5, 2))
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+    def test_no_validators(self):
+        self.server.validators = False
+        self.customer.getAll()
+        self.customer.getAll()
+        self.assertEqual(self._counts(), (0, 2, 0))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
+class ParserTest(unittest.TestCase):
+    ''' The XML parser maps documents like minidom did, and JSON gives the
+        same objects as XML '''
+
+    def assertMatchesMinidom(self, xml):
+        expected = _minidom_records(xml, 'subscription',
+            api.ChargifySubscription.__attribute_types__)
+        self.assertEqual([_fields(obj) for obj in _parse(xml)], expected)
+
+    def test_xml_matches_minidom(self):
+        self.assertMatchesMinidom(_data('subscriptions_1000.xml'))
+
+    def test_edge_cases_match_minidom(self):
+        self.assertMatchesMinidom(EDGE_CASES)
+
+    def test_json_matches_xml(self):
+        xml = _parse(_data('subscriptions_1000.xml'))
+        json = _parse(_data('subscriptions_1000.json'),
+            api.ChargifyJSONCodec())
+        self.assertEqual(len(json), 1000)
+        self.assertEqual([_fields(obj) for obj in json],
+            [_fields(obj) for obj in xml])
+
+    def assertShared(self, body, codec=None):
+        identity_map = api.ChargifyIdentityMap()
+        objs = _parse(body, codec, identity_map=identity_map)
+        unshared = _parse(body, codec)
+        first = {}
+        for obj, plain in zip(objs, unshared):
+            for name, cls in (('product', api.ChargifyProduct),
+                ('customer', api.ChargifyCustomer)):
+                nested = getattr(obj, name)
+                self.assertTrue(nested is identity_map.get(cls, nested.id))
+                first.setdefault((cls, nested.id), getattr(plain, name))
+            self.assertEqual(obj.id, plain.id)
+            self.assertEqual(obj.state, plain.state)
+        # Each nested object is the first copy of it in the document
+        for (cls, nested_id), plain in first.items():
+            self.assertEqual(_fields(identity_map.get(cls, nested_id)),
+                _fields(plain))
+        products = set([id(obj.product) for obj in objs])
+        self.assertEqual(len(products),
+            len(set([obj.product.id for obj in objs])))
+
+    def test_xml_identity_map(self):
+        self.assertShared(_data('subscriptions_1000.xml'))
+
+    def test_json_identity_map(self):
+        self.assertShared(_data('subscriptions_1000.json'),
+            api.ChargifyJSONCodec())
+
+
+class SerializerTest(unittest.TestCase):
+    ''' The string serializer writes what minidom did '''
+
+    def test_fixture(self):
+        for subscription in _parse(_data('subscriptions_1000.xml'))[:200]:
+            self.assertEqual(subscription._toxml(),
+                _minidom_toxml(subscription))
+
+    def test_edge_cases(self):
+        subscriptions = _parse(EDGE_CASES)
+        for subscription in subscriptions:
+            self.assertEqual(subscription._toxml(),
+                _minidom_toxml(subscription))
+
+    def test_values(self):
+        subscription = api.ChargifySubscription(session=_session())
+        subscription.state = u'<a href="x">&amp;</a> \xe9t\xe9 \u20ac'
+        subscription.cancellation_message = ''
+        subscription.balance_in_cents = 0
+        subscription.notes = 'quote " and apostrophe \''
+        subscription.created_at = datetime.datetime(2010, 2, 24, 18, 15, 29)
+        # A nested object with no fields at all
+        subscription.customer = api.ChargifyCustomer(session=_session())
+        subscription.product = api.ChargifyProduct(session=_session())
+        subscription.product.handle = 'plan & <co>'
+        xml = subscription._toxml()
+        self.assertEqual(xml, _minidom_toxml(subscription))
+        self.assertTrue('<customer/>' in xml)
+        self.assertTrue('<cancellation_message></cancellation_message>'
+            in xml)
+        self.assertEqual(api.ChargifySubscription(
+            session=_session())._toxml(), _minidom_toxml(
+            api.ChargifySubscription(session=_session())))
+
+
+class LazyTest(unittest.TestCase):
+    ''' Lazy records decode to the objects the parsers build '''
+
+    def assertSameRecords(self, body, codec=None, shared=False):
+        eager_map = lazy_map = None
+        if shared:
+            eager_map = api.ChargifyIdentityMap()
+            lazy_map = api.ChargifyIdentityMap()
+        eager = _parse(body, codec, identity_map=eager_map)
+        lazy = _parse(body, codec, lazy=True, identity_map=lazy_map)
+        self.assertEqual(len(lazy), len(eager))
+        for eager_obj, lazy_obj in zip(eager, lazy):
+            self.assertEqual(_fields(lazy_obj), _fields(eager_obj))
+
+    def test_edge_cases(self):
+        self.assertSameRecords(EDGE_CASES)
+
+    def test_edge_cases_identity_map(self):
+        self.assertSameRecords(EDGE_CASES, shared=True)
+
+    def test_fields_read_one_at_a_time(self):
+        eager = _parse(EDGE_CASES)[0]
+        lazy = _parse(EDGE_CASES, lazy=True)[0]
+        for name in ('state', 'memo', 'notes', 'cancellation_message',
+            'created_at', 'expires_at'):
+            self.assertEqual(getattr(lazy, name), getattr(eager, name))
+        self.assertEqual(lazy.customer.first_name, u'J\xf6rg')
+        self.assertEqual(lazy.product.handle, 'plan-3')
+
+    def test_xml_fixtures(self):
+        self.assertSameRecords(_data('subscriptions_1000.xml'))
+
+    def test_json_fixtures(self):
+        self.assertSameRecords(_data('subscriptions_1000.json'),
+            api.ChargifyJSONCodec())
+
+
+class ExportTest(unittest.TestCase):
+    ''' exportAll: windows of pages, ordering, the last page, failures and
+        checkpoints '''
+
+    def setUp(self):
+        self.server = PagingServer(records=110)
+        self.session = _start(self.server)
+        self.subscription = api.ChargifySubscription(session=self.session)
+        self.expected = [str(i) for i in xrange(1, 111)]
+        self.checkpoint = os.path.join(tempfile.gettempdir(),
+            'pychargify-export-%d.checkpoint' % os.getpid())
+
+    def tearDown(self):
+        _stop(self.server, self.session)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def export(self, **kwargs):
+        return [obj.id for obj in self.subscription.exportAll(per_page=10,
+            **kwargs)]
+
+    def test_in_order(self):
+        self.server.slow_pages[1] = 0.2
+        self.assertEqual(self.export(window=4), self.expected)
+        self.assertTrue(self.server.max_busy <= 4)
+
+    def test_as_completed(self):
+        self.server.slow_pages[1] = 0.2
+        ids = self.export(window=4, ordered=False)
+        self.assertEqual(sorted(ids), sorted(self.expected))
+        self.assertNotEqual(ids[:10], self.expected[:10])
+        self.assertTrue(self.server.max_busy <= 4)
+
+    def test_window(self):
+        self.export(window=3)
+        self.assertEqual(self.server.max_busy, 3)
+        self.server.max_busy = 0
+        self.export(window=1)
+        self.assertEqual(self.server.max_busy, 1)
+
+    def test_exact_last_page(self):
+        ids = [obj.id for obj in self.subscription.exportAll(per_page=11,
+            window=4)]
+        self.assertEqual(ids, self.expected)
+
+    def test_failure_past_the_last_page(self):
+        # 110 records end with an empty page 12; pages past it fail, and
+        # come back before it
+        self.server.slow_pages[12] = 0.2
+        self.server.failing_pages.update([13, 14])
+        self.assertEqual(self.export(window=4), self.expected)
+        self.assertEqual(sorted(self.export(window=4, ordered=False)),
+            sorted(self.expected))
+
+    def test_failure(self):
+        self.server.failing_pages.add(5)
+        for ordered in (True, False):
+            ids = []
+            try:
+                for obj in self.subscription.exportAll(per_page=10,
+                    window=4, ordered=ordered):
+                    ids.append(obj.id)
+            except api.ChargifyNotFound:
+                pass
+            else:
+                self.fail('page 5 failed silently')
+            if ordered:
+                self.assertEqual(ids, self.expected[:40])
+
+    def test_checkpoint(self):
+        export = self.subscription.exportAll(per_page=10, window=4,
+            checkpoint=self.checkpoint)
+        first = [export.next().id for i in xrange(35)]
+        export.close()
+        self.assertEqual(first, self.expected[:35])
+        self.assertEqual(api._read_checkpoint(self.checkpoint,
+            '/subscriptions.xml', 10), 3)
+        # A checkpoint of another page size is no use
+        self.assertEqual(api._read_checkpoint(self.checkpoint,
+            '/subscriptions.xml', 20), 0)
+
+        rest = self.export(window=4, checkpoint=self.checkpoint)
+        self.assertEqual(rest, self.expected[30:])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class ReplicaTest(unittest.TestCase):
+    ''' The replica syncs from a stub account and answers queries from
+        its database, in a time zone other than UTC '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tz = _set_time_zone('Asia/Tokyo')
+
+    @classmethod
+    def tearDownClass(cls):
+        _set_time_zone(cls.tz)
+
+    def setUp(self):
+        self.server = PagingServer(records=120)
+        self.session = _start(self.server)
+        chargify = api.Chargify('offline', 'offline')
+        chargify.session = self.session
+        self.replica = replica.ChargifyReplica(chargify, per_page=50)
+        self.replica.sync()
+
+    def tearDown(self):
+        self.replica.close()
+        _stop(self.server, self.session)
+
+    def _ids(self, objs):
+        return [int(obj.id) for obj in objs]
+
+    def _expected(self, test):
+        return [fields['id'] for fields in self.server.fields if test(fields)]
+
+    def test_sync(self):
+        newest = max([iso8601.parse(fields['updated'])
+            for fields in self.server.fields])
+        stats = self.replica.stats()
+        self.assertEqual(stats['products'], 5)
+        self.assertEqual(stats['customers'], 40)
+        self.assertEqual(stats['subscriptions'], 120)
+        self.assertEqual(api._timestamp(stats['subscriptions_updated_at']),
+            newest)
+        self.assertEqual(self.replica.sync(), {'products': 5,
+            'customers': 40, 'subscriptions': 120})
+
+    def test_incremental_sync(self):
+        for name in ('customers', 'subscriptions'):
+            self.assertEqual([query for path, query in self.server.queries
+                if path == '/%s.xml' % name and 'start_datetime' in query],
+                [])
+        del self.server.queries[:]
+        self.replica.sync()
+        for name in ('customers', 'subscriptions'):
+            fields = name == 'customers' and self.server.customers.values() \
+                or self.server.fields
+            since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(max(
+                [iso8601.parse(f['updated']) for f in fields]) - 60))
+            queries = [query for path, query in self.server.queries
+                if path == '/%s.xml' % name]
+            self.assertTrue(queries)
+            for query in queries:
+                self.assertEqual(query['date_field'], 'updated_at')
+                self.assertEqual(query['start_datetime'], since)
+
+    def test_refresh(self):
+        # Subscriptions past the 100th are gone from the account
+        del self.server.fields[100:]
+        self.assertEqual(self.replica.refresh([5, 110]),
+            {'refreshed': 1, 'removed': 1, 'failed': 0})
+        self.assertEqual(self.replica.subscription(5).state,
+            self.server.fields[4]['state'])
+        self.assertEqual(self.replica.subscription(110), None)
+        self.assertEqual(self.replica.stats()['subscriptions'], 119)
+
+    def test_apply_postback(self):
+        del self.server.fields[100:]
+        postback = api.ChargifyPostBack('offline', 'offline', '[7, 115, 116]',
+            2, self.session)
+        self.assertEqual(self.replica.apply_postback(postback),
+            {'refreshed': 1, 'removed': 2, 'failed': 0})
+        self.assertEqual(self._ids(self.replica.subscriptions()),
+            range(1, 115) + range(117, 121))
+
+    def test_queries(self):
+        self.assertEqual(self._ids(self.replica.subscriptions(
+            state='past_due')), self._expected(
+            lambda fields: fields['state'] == 'past_due'))
+        self.assertEqual(self._ids(self.replica.subscriptions(
+            customer_id=2)), [4, 5, 6])
+        self.assertEqual(self._ids(self.replica.subscriptions(
+            product_id=3)), self._expected(
+            lambda fields: fields['product'] == 3))
+        self.assertEqual(self._ids(self.replica.subscriptions(
+            state='active', product_id='3')), self._expected(
+            lambda fields: fields['product'] == 3 and
+            fields['state'] == 'active'))
+
+    def test_period_end_range(self):
+        # Bounds in other time zones than the records', right on two of them
+        ends = sorted([iso8601.parse_datetime(fields['ends'])
+            for fields in self.server.fields])
+        after = ends[30].astimezone(iso8601.FixedOffset(-14 * 3600))
+        before = ends[90].astimezone(iso8601.FixedOffset(-10 * 3600))
+        subscriptions = self.replica.subscriptions(ends_after=after,
+            ends_before=before)
+        self.assertEqual(len(subscriptions), 60)
+        self.assertEqual(self._ids(subscriptions), self._expected(
+            lambda fields: ends[30] <= iso8601.parse_datetime(
+            fields['ends']) < ends[90]))
+        for subscription in subscriptions:
+            self.assertEqual(subscription.customer.id,
+                str((int(subscription.id) - 1) // 3 + 1))
+
+
+class RateLimitTest(unittest.TestCase):
+    ''' The rate limiter retries what it may, honours Retry-After and
+        counts what it did '''
+
+    def setUp(self):
+        self.server = ScriptedServer(records=10)
+        self.session = _start(self.server)
+        self.limiter = self.session.rate_limiter = api.ChargifyRateLimiter(
+            max_retries=2, backoff=0.01)
+        self.customer = api.ChargifyCustomer(session=self.session)
+        self.subscription = api.ChargifySubscription(session=self.session)
+        self.subscription.id = 1
+
+    def tearDown(self):
+        _stop(self.server, self.session)
+
+    def test_post_rate_limited(self):
+        self.server.statuses = [429]
+        self.assertEqual(self.subscription.createUsage(10, 3)[0].quantity, 3)
+        self.assertEqual(self.server.stats['requests'], 2)
+        stats = self.limiter.stats()
+        self.assertEqual((stats['requests'], stats['retries'],
+            stats['rate_limited']), (2, 1, 1))
+
+    def test_post_server_error(self):
+        self.server.statuses = [503]
+        self.assertRaises(api.ChargifyServerError,
+            self.subscription.createUsage, 10, 3)
+        self.assertEqual(self.server.stats['requests'], 1)
+        self.assertEqual(self.limiter.stats()['retries'], 0)
+
+    def test_get_retries(self):
+        self.server.statuses = [503, 502]
+        self.assertEqual(self.customer.getById(1).id, '1')
+        self.assertEqual(self.server.stats['requests'], 3)
+        self.assertEqual(self.limiter.stats()['retries'], 2)
+
+    def test_get_gives_up(self):
+        for status, error in ((503, api.ChargifyServerError),
+            (429, api.ChargifyRateLimited)):
+            self.server.stats['requests'] = 0
+            self.server.statuses = [status] * 3
+            self.assertRaises(error, self.customer.getById, 1)
+            self.assertEqual(self.server.stats['requests'], 3)
+            self.assertEqual(self.server.statuses, [])
+        stats = self.limiter.stats()
+        self.assertEqual((stats['requests'], stats['retries'],
+            stats['rate_limited']), (6, 4, 2))
+
+    def _retry_time(self, retry_after):
+        self.server.retry_after = retry_after
+        self.server.statuses = [429]
+        started_at = time.time()
+        self.customer.getById(1)
+        return time.time() - started_at
+
+    def test_retry_after_seconds(self):
+        self.assertTrue(self._retry_time(0.3) >= 0.3)
+        stats = self.limiter.stats()
+        self.assertEqual((stats['retries'], stats['rate_limited']), (1, 1))
+
+    def test_pause(self):
+        # A 429 holds back the other requests of the session too
+        self.server.retry_after = 0.5
+        self.server.statuses = [429]
+        thread = threading.Thread(target=self.customer.getById, args=(1,))
+        thread.start()
+        while not self.limiter.rate_limited:
+            time.sleep(0.01)
+        started_at = time.time()
+        self.customer.getById(2)
+        self.assertTrue(time.time() - started_at >= 0.3)
+        thread.join()
+        self.assertTrue(self.limiter.stats()['throttled'] >= 1)
+
+    def test_retry_after_date(self):
+        # HTTP dates are to the second; this one is at least a second away
+        self.assertTrue(self._retry_time(formatdate(time.time() + 2,
+            usegmt=True)) >= 0.9)
+
+    def test_throttle(self):
+        self.limiter.rate = 20
+        started_at = time.time()
+        for i in xrange(5):
+            self.customer.getById(1)
+        self.assertTrue(time.time() - started_at >= 0.19)
+        stats = self.limiter.stats()
+        self.assertEqual((stats['requests'], stats['throttled'],
+            stats['retries']), (5, 4, 0))
+        self.assertTrue(stats['throttle_time'] > 0)
+
+
+class PostBackTest(unittest.TestCase):
+    ''' A postback fetches every id once, keeps the input order and
+        reports the ids it couldn't fetch '''
+
+    def setUp(self):
+        # Jitter, so the fetches finish out of order
+        self.server = StubServer(records=20, jitter=0.05)
+        self.session = _start(self.server)
+
+    def tearDown(self):
+        _stop(self.server, self.session)
+
+    def _postback(self, data, concurrency=4):
+        return api.ChargifyPostBack('offline', 'offline', data, concurrency,
+            self.session)
+
+    def test_postback(self):
+        for concurrency in (1, 4):
+            self.server.stats['requests'] = 0
+            postback = self._postback('[5, 3, 99, 5, 1, 3, 42, 2, 20]',
+                concurrency)
+            self.assertEqual([subscription.id for subscription in
+                postback.subscriptions], ['5', '3', '1', '2', '20'])
+            self.assertEqual([id for id, error in postback.failures],
+                [99, 42])
+            for id, error in postback.failures:
+                self.assertTrue(isinstance(error, api.ChargifyNotFound))
+            self.assertEqual(self.server.stats['requests'], 7)
+
+    def test_empty(self):
+        postback = self._postback('[]')
+        self.assertEqual((postback.subscriptions, postback.failures),
+            ([], []))
+        self.assertEqual(self.server.stats['requests'], 0)
+
+
+# Records usage in a process of its own and exits without closing the
+# recorder
+UNCLOSED_RECORDER = '''
+import sys
+import api
+import test_offline
+
+def report(subscription_id, component_id, quantity, memo, result, error):
+    print subscription_id, component_id, quantity, memo, error
+
+server = test_offline.StubServer(records=10)
+recorder = api.ChargifyUsageRecorder(api.ChargifySubscription(
+    session=test_offline._start(server)), interval=60, callback=report)
+recorder.record(1, 10, 5, 'exit')
+'''
+
+
+class UsageTest(unittest.TestCase):
+    ''' The usage recorder merges, sends on size and on time, and reports
+        every request '''
+
+    def setUp(self):
+        self.server = StubServer(records=10)
+        self.session = _start(self.server)
+        self.sent = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        _stop(self.server, self.session)
+
+    def _recorder(self, count=None, **kwargs):
+        def callback(*args):
+            self.sent.append(args)
+            if len(self.sent) == count:
+                self.done.set()
+        return api.ChargifyUsageRecorder(api.ChargifySubscription(
+            session=self.session), callback=callback, **kwargs)
+
+    def test_merge(self):
+        recorder = self._recorder(max_pending=10, interval=60)
+        recorder.record(1, 10, 2, 'a')
+        recorder.record(2, 10, 4)
+        recorder.record(1, 10, 3, 'b')
+        recorder.record(1, 11, 7)
+        recorder.record(1, 10, 1, 'a')
+        recorder.flush(wait=True)
+        self.assertEqual(self.server.stats['requests'], 3)
+        self.assertEqual(sorted([args[:4] + (args[5],)
+            for args in self.sent]), [(1, 10, 6, 'a; b', None),
+            (1, 11, 7, None, None), (2, 10, 4, None, None)])
+        for args in self.sent:
+            self.assertEqual(args[4][0].quantity, args[2])
+        recorder.close()
+
+    def test_size_trigger(self):
+        recorder = self._recorder(3, max_pending=3, interval=60)
+        for subscription_id in (1, 2, 3):
+            recorder.record(subscription_id, 10, 1)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(sorted([args[0] for args in self.sent]), [1, 2, 3])
+        recorder.close()
+
+    def test_interval_trigger(self):
+        recorder = self._recorder(1, max_pending=100, interval=0.2)
+        recorder.record(1, 10, 1)
+        self.assertTrue(self.done.wait(5))
+        recorder.close()
+
+    def test_failure(self):
+        with self._recorder() as recorder:
+            recorder.record(99, 10, 1)
+            recorder.record(1, 10, 1)
+        self.assertEqual(len(self.sent), 2)
+        for args in self.sent:
+            if args[0] == 99:
+                self.assertEqual(args[4], None)
+                self.assertTrue(isinstance(args[5], api.ChargifyNotFound))
+            else:
+                self.assertEqual(args[5], None)
+        self.assertRaises(api.ChargifyError, recorder.record, 1, 10, 1)
+
+    def test_exit(self):
+        output = subprocess.check_output([sys.executable, '-c',
+            UNCLOSED_RECORDER], cwd=os.path.dirname(os.path.abspath(
+            __file__)), stderr=open(os.devnull, 'w'))
+        self.assertEqual(output, '1 10 5 exit None\n')
+
+
+class CompressionTest(unittest.TestCase):
+    ''' Compressed responses decode to the same objects as plain ones,
+        and the compressed bytes are what gets counted '''
+
+    def _fetch(self, accept_encoding, handler=None):
+        server = StubServer(records=120, compress=True)
+        if handler is not None:
+            server.RequestHandlerClass = handler
+        session = _start(server)
+        session.accept_encoding = accept_encoding
+        # Small reads, so bodies are decompressed over many chunks
+        session.read_size = 1024
+        events = []
+        session.instrument = events.append
+        try:
+            subscriptions = api.ChargifySubscription(
+                session=session).getAll()
+        finally:
+            _stop(server, session)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(sum([event['bytes_in'] for event in events]),
+            server.stats['bytes'])
+        return [_fields(subscription) for subscription in subscriptions], \
+            server.stats['bytes']
+
+    def test_compressed(self):
+        expected, plain_size = self._fetch(None)
+        self.assertEqual(len(expected), 120)
+        for accept_encoding, handler in (('gzip', None),
+            ('deflate', None), ('deflate', RawDeflateHandler)):
+            fields, size = self._fetch(accept_encoding, handler)
+            self.assertEqual(fields, expected)
+            self.assertTrue(size < plain_size / 4)
+
+
+class AsyncTest(unittest.TestCase):
+    ''' AsyncChargify against a stub server '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(records=120)
+        cls.host = '127.0.0.1:%d' % cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.chargify = api.AsyncChargify('offline', 'offline',
+            concurrency=2, host=self.host, secure=False)
+
+    def tearDown(self):
+        self.chargify.close()
+
+    def test_generators_are_drained_in_the_worker(self):
+        for method in ('iterAll', 'exportAll'):
+            result = getattr(self.chargify.Subscription(), method)(
+                per_page=50)
+            subscriptions = result.get(10)
+            self.assertTrue(isinstance(subscriptions, list))
+            self.assertEqual(len(subscriptions), 120)
+            self.assertTrue(isinstance(subscriptions[0],
+                api.AsyncChargifyObject))
+            self.assertEqual(subscriptions[0].id, '1')
+
+    def test_local_methods_are_called_directly(self):
+        requests = self.server.stats['requests']
+        product = self.chargify.Product()
+        product.price_in_cents = 1250
+        self.assertEqual(product.getPriceInDollars(), 12.5)
+        self.assertEqual(product.getFormattedPrice(), '$12.50')
+        self.assertEqual(self.server.stats['requests'], requests)
+
+    def test_api_calls_return_async_results(self):
+        subscription = self.chargify.Subscription().getBySubscriptionId(1)
+        self.assertEqual(subscription.get(10).id, '1')
+
+
+if __name__ == "__main__":
+    unittest.main()